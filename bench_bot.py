@@ -0,0 +1,379 @@
+"""Офлайн-нагрузочный тест бота.
+
+Поднимает локальные заглушки Telegram Bot API, DeepSeek, OpenWeather, курсов валют,
+CoinGecko и API-Football, прогоняет через BotApp синтетические потоки обновлений и
+печатает пропускную способность, p50/p95/p99 и число запросов к БД по сценариям.
+
+Нужен локальный PostgreSQL: адрес берётся из BENCH_DATABASE_URL. Таблицы создаются
+миграциями бота, поэтому лучше указывать отдельную пустую базу.
+
+    BENCH_DATABASE_URL=postgresql://localhost/bench python bench_bot.py --json bench.json
+    BENCH_DATABASE_URL=postgresql://localhost/bench python bench_bot.py --baseline bench.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import socket
+import statistics
+import sys
+import time
+
+from aiohttp import web
+
+BENCH_TOKEN = "123456:BENCHbenchBENCHbenchBENCHbenchBENCH"
+BENCH_BOT_USERNAME = "benchbot"
+BENCH_TARGET_USER_ID = 660949286
+SCENARIOS = ["chatter", "trigger", "ai", "team", "morning"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк бота на локальных заглушках")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Сценарии через запятую")
+    parser.add_argument("--scale", type=float, default=1.0, help="Множитель числа обновлений в сценариях")
+    parser.add_argument("--concurrency", type=int, default=50, help="Одновременно обрабатываемых обновлений")
+    parser.add_argument("--deepseek-latency", type=float, default=0.3, help="Задержка до первого токена DeepSeek, с")
+    parser.add_argument("--deepseek-chunk-delay", type=float, default=0.02, help="Задержка между фрагментами потока, с")
+    parser.add_argument("--deepseek-chunks", type=int, default=20, help="Фрагментов в ответе DeepSeek")
+    parser.add_argument("--no-streaming", action="store_true", help="Отключить потоковые ответы AI")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="Задержка погоды, курсов и футбольного API, с")
+    parser.add_argument("--primary-quote-latency", type=float, help="Задержка основных провайдеров котировок (jsDelivr, CoinGecko), с")
+    parser.add_argument("--telegram-latency", type=float, default=0.02, help="Задержка Telegram Bot API, с")
+    parser.add_argument("--real-limits", action="store_true", help="Не ослаблять лимиты исходящих запросов к Telegram")
+    parser.add_argument("--json", help="Сохранить результаты в JSON")
+    parser.add_argument("--baseline", help="Сравнить с ранее сохранённым JSON")
+    return parser.parse_args()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def configure_environment(args, port):
+    # Переменные задаются до импорта bot: он читает их при загрузке модуля
+    base = f"http://127.0.0.1:{port}"
+    database_url = os.getenv("BENCH_DATABASE_URL")
+    if not database_url:
+        sys.exit("Укажите BENCH_DATABASE_URL — адрес локального PostgreSQL для бенчмарка")
+    os.environ.update({
+        "TELEGRAM_TOKEN": BENCH_TOKEN,
+        "DEEPSEEK_API_KEY": "bench",
+        "OPENWEATHER_API_KEY": "bench",
+        "RAPIDAPI_KEY": "bench",
+        "CHAT_ID": "-1002362736664",
+        "DATABASE_URL": database_url,
+        "TARGET_USER_ID": str(BENCH_TARGET_USER_ID),
+        "RESPONSES_SOSAL": json.dumps(["Сосал", "Не сосал"], ensure_ascii=False),
+        "RARE_RESPONSE_SOSAL": "Редкий ответ",
+        "RESPONSE_LETAL": "Летал",
+        "RESPONSES_SCAMIL": json.dumps(["Скамил"], ensure_ascii=False),
+        "TEAM_IDS": json.dumps({"real": 541, "lfc": 40, "arsenal": 42}),
+        "TARGET_REACTION": "👍",
+        "AI_STREAMING": "false" if args.no_streaming else "true",
+        "TELEGRAM_API_URL": f"{base}/telegram",
+        "DEEPSEEK_BASE_URL": f"{base}/deepseek",
+        "OPENWEATHER_API_URL": f"{base}/openweather",
+        "CURRENCY_API_URL": f"{base}/currency",
+        "CURRENCY_FALLBACK_API_URL": f"{base}/currency-fallback",
+        "EXCHANGE_RATE_API_URL": f"{base}/er-api",
+        "COINGECKO_API_URL": f"{base}/coingecko",
+        "BINANCE_API_URL": f"{base}/binance",
+        "FOOTBALL_API_URL": f"{base}/football",
+        "METRICS_PORT": "0",
+        "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING"),
+        "LOG_MESSAGE_SAMPLE_RATE": "0",
+    })
+
+
+# Заглушки внешних сервисов
+class StandIns:
+    def __init__(self, args):
+        self.args = args
+        self.message_ids = itertools.count(1_000_000)
+        self.calls = {}
+
+    def count(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_post("/telegram/bot{token}/{method}", self.telegram)
+        app.router.add_post("/deepseek/chat/completions", self.deepseek)
+        app.router.add_get("/openweather/weather", self.weather)
+        app.router.add_get("/currency/currencies/usd.json", self.currency)
+        app.router.add_get("/currency-fallback/currencies/usd.json", self.currency)
+        app.router.add_get("/er-api/latest/USD", self.er_api)
+        app.router.add_get("/coingecko/simple/price", self.crypto)
+        app.router.add_get("/binance/ticker/price", self.binance)
+        app.router.add_get("/football/fixtures", self.fixtures)
+        app.router.add_get("/football/fixtures/events", self.events)
+        return app
+
+    async def telegram(self, request):
+        method = request.match_info["method"].lower()
+        self.count(f"telegram.{method}")
+        await asyncio.sleep(self.args.telegram_latency)
+        data = await request.post()
+        if method == "getme":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": BENCH_BOT_USERNAME}
+        elif method in ("sendmessage", "editmessagetext"):
+            chat_id = int(data.get("chat_id", 0))
+            message_id = int(data["message_id"]) if "message_id" in data else next(self.message_ids)
+            result = {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "Bench", "username": BENCH_BOT_USERNAME},
+                "text": data.get("text", ""),
+            }
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def deepseek(self, request):
+        body = await request.json()
+        self.count("deepseek.stream" if body.get("stream") else "deepseek.completion")
+        await asyncio.sleep(self.args.deepseek_latency)
+        chunks = [f"кусок{index} " for index in range(self.args.deepseek_chunks)]
+        usage = {"prompt_tokens": 500, "completion_tokens": len(chunks) * 2, "total_tokens": 500 + len(chunks) * 2,
+                 "prompt_cache_hit_tokens": 400, "prompt_cache_miss_tokens": 100}
+        base = {"id": "bench", "created": int(time.time()), "model": "deepseek-chat"}
+        if not body.get("stream"):
+            await asyncio.sleep(self.args.deepseek_chunk_delay * len(chunks))
+            return web.json_response({
+                **base, "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(chunks)}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for chunk in chunks:
+            event = {**base, "object": "chat.completion.chunk",
+                     "choices": [{"index": 0, "delta": {"content": chunk}, "finish_reason": None}]}
+            await response.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode())
+            await asyncio.sleep(self.args.deepseek_chunk_delay)
+        final = {**base, "object": "chat.completion.chunk", "choices": [], "usage": usage}
+        await response.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode())
+        await response.write_eof()
+        return response
+
+    async def weather(self, request):
+        self.count("openweather")
+        await asyncio.sleep(self.args.api_latency)
+        return web.json_response({"main": {"temp": round(random.uniform(-10, 30), 1)}, "weather": [{"description": "облачно"}]})
+
+    def quote_latency(self, primary):
+        if primary and self.args.primary_quote_latency is not None:
+            return self.args.primary_quote_latency
+        return self.args.api_latency
+
+    async def currency(self, request):
+        primary = request.path.startswith("/currency/")
+        self.count("currency" if primary else "currency-fallback")
+        await asyncio.sleep(self.quote_latency(primary))
+        return web.json_response({"usd": {"byn": 3.27, "rub": 92.5}})
+
+    async def er_api(self, request):
+        self.count("er-api")
+        await asyncio.sleep(self.args.api_latency)
+        return web.json_response({"result": "success", "rates": {"BYN": 3.27, "RUB": 92.5}})
+
+    async def crypto(self, request):
+        self.count("coingecko")
+        await asyncio.sleep(self.quote_latency(True))
+        return web.json_response({"bitcoin": {"usd": 67000.0}, "worldcoin": {"usd": 2.1}})
+
+    async def binance(self, request):
+        self.count("binance")
+        await asyncio.sleep(self.args.api_latency)
+        return web.json_response([{"symbol": "BTCUSDT", "price": "67000.00"}, {"symbol": "WLDUSDT", "price": "2.10"}])
+
+    async def fixtures(self, request):
+        self.count("football.fixtures")
+        await asyncio.sleep(self.args.api_latency)
+        team_id = int(request.query["team"])
+        response = []
+        for index in range(5):
+            response.append({
+                "fixture": {"id": team_id * 100 + index, "date": f"2024-05-0{index + 1}T19:00:00+00:00", "status": {"short": "FT"}},
+                "teams": {"home": {"id": team_id, "name": "Home"}, "away": {"id": 1, "name": "Away"}},
+                "goals": {"home": 2, "away": 1},
+            })
+        return web.json_response({"response": response})
+
+    async def events(self, request):
+        self.count("football.events")
+        await asyncio.sleep(self.args.api_latency)
+        return web.json_response({"response": [
+            {"type": "Goal", "player": {"name": "Игрок"}, "time": {"elapsed": 10 + minute}} for minute in range(3)
+        ]})
+
+
+# Синтетические обновления
+class UpdateFactory:
+    def __init__(self, bot_module):
+        self.bot_module = bot_module
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+
+    def message(self, chat_id, user_id, text):
+        from aiogram.types import Update
+        return Update.model_validate({
+            "update_id": next(self.update_ids),
+            "message": {
+                "message_id": next(self.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+                "text": text,
+            },
+        })
+
+    def scenario_updates(self, name, scale):
+        target = self.bot_module.TARGET_CHAT_ID
+        count = lambda base: max(1, int(base * scale))
+        if name == "chatter":
+            # Обычная переписка в чате с историей: только сохранение и реакции
+            users = [BENCH_TARGET_USER_ID] + list(range(1000, 1010))
+            return [self.message(target, random.choice(users), f"сообщение {index}") for index in range(count(500))]
+        if name == "trigger":
+            words = ["сосал?", "летал?", "скамил?"]
+            return [self.message(target, 1000 + index % 10, random.choice(words)) for index in range(count(200))]
+        if name == "ai":
+            # Вопросы к AI в нескольких чатах, чтобы не упираться в очередь одного чата
+            chats = [target] + [-100 - index for index in range(9)]
+            return [
+                self.message(chats[index % len(chats)], 1000 + index % 10, f"@{BENCH_BOT_USERNAME} вопрос номер {index}")
+                for index in range(count(50))
+            ]
+        if name == "team":
+            return [self.message(target, 1000 + index % 10, random.choice(["/lfc", "/real", "/arsenal"])) for index in range(count(20))]
+        raise ValueError(name)
+
+
+def percentile(values, fraction):
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[int(fraction * 100) - 1]
+
+
+def db_query_count(metrics):
+    series = metrics.histograms.get("db_query_seconds", {})
+    return sum(count for _, _, count in series.values())
+
+
+async def settle(app):
+    # Дожидаемся фоновых задач и сбрасываем буфер chat_history, чтобы учесть их запросы
+    while app.background_tasks:
+        await asyncio.wait(set(app.background_tasks))
+    await app.history_writer.flush()
+
+
+async def run_scenario(name, app, bot_module, stand_ins, factory, args):
+    metrics = bot_module.metrics
+    queries_before = db_query_count(metrics)
+    batches_before = metrics.counters.get("chat_history_batches_total", {}).get((), 0)
+    calls_before = dict(stand_ins.calls)
+    latencies = []
+    started = time.monotonic()
+    if name == "morning":
+        for _ in range(max(1, int(5 * args.scale))):
+            run_started = time.monotonic()
+            await app.morning_sender.prefetch_morning_message()
+            await app.morning_sender.send_morning_message()
+            latencies.append(time.monotonic() - run_started)
+    else:
+        updates = factory.scenario_updates(name, args.scale)
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def feed(update):
+            async with semaphore:
+                update_started = time.monotonic()
+                await app.dp.feed_update(app.bot, update)
+                latencies.append(time.monotonic() - update_started)
+
+        await asyncio.gather(*(feed(update) for update in updates))
+    elapsed = time.monotonic() - started
+    await settle(app)
+    latencies.sort()
+    return {
+        "updates": len(latencies),
+        "seconds": round(elapsed, 3),
+        "throughput": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "db_queries": db_query_count(metrics) - queries_before,
+        "db_copy_batches": metrics.counters.get("chat_history_batches_total", {}).get((), 0) - batches_before,
+        "upstream_calls": {key: value - calls_before.get(key, 0) for key, value in stand_ins.calls.items() if value != calls_before.get(key, 0)},
+    }
+
+
+def print_report(results, baseline):
+    header = f"{'сценарий':<10} {'обновл.':>8} {'upd/s':>8} {'p50 мс':>9} {'p95 мс':>9} {'p99 мс':>9} {'запр. БД':>9} {'COPY':>6}"
+    print(header)
+    print("-" * len(header))
+    for name, result in results.items():
+        print(
+            f"{name:<10} {result['updates']:>8} {result['throughput']:>8} {result['p50_ms']:>9} "
+            f"{result['p95_ms']:>9} {result['p99_ms']:>9} {result['db_queries']:>9} {result['db_copy_batches']:>6}"
+        )
+        base = (baseline or {}).get(name)
+        if base:
+            deltas = []
+            for key in ("throughput", "p50_ms", "p95_ms", "p99_ms", "db_queries"):
+                if base.get(key):
+                    deltas.append(f"{key} {(result[key] - base[key]) / base[key] * 100:+.1f}%")
+            print(f"{'':<10} к базовой линии: {', '.join(deltas)}")
+    print()
+    for name, result in results.items():
+        print(f"{name}: внешние вызовы {result['upstream_calls']}")
+
+
+async def main():
+    args = parse_args()
+    port = free_port()
+    configure_environment(args, port)
+    import bot as bot_module
+
+    if not args.real_limits:
+        # Лимиты Telegram растягивают прогон на минуты; по умолчанию меряем сам бот
+        bot_module.TELEGRAM_GLOBAL_RATE = bot_module.TELEGRAM_GLOBAL_BURST = 100000
+        bot_module.TELEGRAM_GROUP_RATE = bot_module.TELEGRAM_GROUP_BURST = 100000
+        bot_module.TELEGRAM_PRIVATE_RATE = bot_module.TELEGRAM_PRIVATE_BURST = 100000
+
+    stand_ins = StandIns(args)
+    runner = web.AppRunner(stand_ins.create_app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+
+    app = bot_module.BotApp()
+    app.setup_handlers()
+    await app.on_startup()
+    factory = UpdateFactory(bot_module)
+    results = {}
+    try:
+        for name in [scenario.strip() for scenario in args.scenarios.split(",") if scenario.strip()]:
+            if name not in SCENARIOS:
+                sys.exit(f"Неизвестный сценарий: {name}")
+            results[name] = await run_scenario(name, app, bot_module, stand_ins, factory, args)
+    finally:
+        await app.on_shutdown()
+        await runner.cleanup()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            baseline = json.load(file)
+    print_report(results, baseline)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(results, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
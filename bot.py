@@ -2,37 +2,231 @@ import random
 import os
 import asyncio
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import multiprocessing
+import signal
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+import copy
 import sys
-from datetime import datetime
-from aiogram import Bot, Dispatcher, types
+from datetime import datetime, timedelta, timezone
+import aiogram
+from aiogram import Bot, Dispatcher, F, types
+from aiogram.enums import ParseMode
 from aiogram.filters import Command
-from aiogram.types import ReactionTypeEmoji
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, ReactionTypeEmoji
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.methods import SetMessageReaction
+import openai
 from openai import AsyncOpenAI
 import aiohttp
+from aiohttp import web
+import httpx
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.schedulers.base import STATE_PAUSED
 from apscheduler.triggers.cron import CronTrigger
 import pytz
 from functools import partial
+from collections import OrderedDict, deque
+import itertools
+import heapq
+import contextlib
 import asyncpg
 import json
-
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler(sys.stdout)]
+import re
+import time
+from urllib.parse import quote, urlsplit
+from history_archive import (
+    CHAT_HISTORY_COLUMNS, month_start, next_month, chat_history_partition_name,
+    create_chat_history_partition, export_chat_history
 )
+
+# Настройки логирования читаются напрямую: get_env_var сам пишет в лог
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+LOG_MESSAGE_SAMPLE_RATE = float(os.getenv('LOG_MESSAGE_SAMPLE_RATE', '0.1'))  # доля логируемых сообщений чата
+LOG_CONTENT_MAX_CHARS = int(os.getenv('LOG_CONTENT_MAX_CHARS', '0'))  # 0 — текст сообщений в лог не попадает
+
+# JSON-строка на каждую запись; дополнительные поля передаются через extra={"fields": {...}}
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        payload = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        payload.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            payload["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            payload["exception"] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+# Обработчик не ждёт вывода: при переполненной очереди запись отбрасывается, а не блокирует цикл событий
+class DroppingQueueHandler(QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Текст сообщения и трассировка готовятся сразу, остальное форматирование — в потоке QueueListener
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+# Настройка логирования: запись в stdout идёт в отдельном потоке QueueListener
+log_handler = logging.StreamHandler(sys.stdout)
+log_handler.setFormatter(JsonFormatter())
+log_queue_handler = DroppingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+log_listener = QueueListener(log_queue_handler.queue, log_handler)
+logging.basicConfig(level=LOG_LEVEL, handlers=[log_queue_handler])
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
+def redact(text):
+    if LOG_CONTENT_MAX_CHARS <= 0:
+        return f"<{len(text)} симв.>"
+    return text if len(text) <= LOG_CONTENT_MAX_CHARS else text[:LOG_CONTENT_MAX_CHARS] + "…"
+
+def log_sampled(message, **fields):
+    # Логи на каждое сообщение чата пишем выборочно, с долей LOG_MESSAGE_SAMPLE_RATE
+    if random.random() < LOG_MESSAGE_SAMPLE_RATE:
+        logger.info(message, extra={"fields": fields})
+
+class SampledInfoFilter(logging.Filter):
+    # Для логгеров, пишущих INFO на каждое обновление: такие записи пропускаются с долей LOG_MESSAGE_SAMPLE_RATE
+    def filter(self, record):
+        return record.levelno > logging.INFO or random.random() < LOG_MESSAGE_SAMPLE_RATE
+
+# aiogram пишет «Update id=… is handled» на каждое обновление
+logging.getLogger("aiogram.event").addFilter(SampledInfoFilter())
+
 # Версия кода
 CODE_VERSION = "2.7"
 
 # Константы
 MAX_TOKENS = 999
 AI_TEMPERATURE = 1.5
+AI_HISTORY_TOKEN_BUDGET = 3000  # бюджет токенов на историю чата в запросе к AI
+AI_HISTORY_BLOCK_TURNS = 10  # на сколько сообщений сразу сдвигается начало окна истории
+AI_SUMMARY_MAX_TOKENS = 400
+AI_SUMMARY_BATCH_TURNS = 10  # сколько выпавших из окна сообщений копим перед обновлением сводки
+AI_MAX_CONCURRENCY = 4  # одновременных запросов к DeepSeek
+AI_MAX_QUEUE = 20  # запросов, ожидающих свободного слота
+AI_MAX_RETRIES = 2
+AI_RETRY_BACKOFF = 1  # секунды, удваивается с каждой попыткой
+AI_BREAKER_THRESHOLD = 5  # подряд неудачных запросов до размыкания
+AI_BREAKER_COOLDOWN = 30  # секунды, в течение которых запросы сразу отклоняются
+AI_REQUEST_TIMEOUT = 60  # секунды на весь запрос к DeepSeek, включая потоковый ответ целиком
+AI_CONNECT_TIMEOUT = 5  # секунды
+AI_STREAM_EDIT_INTERVAL = 3  # секунды между правками сообщения при потоковом ответе
+TELEGRAM_MESSAGE_LIMIT = 4096
 CHAT_HISTORY_LIMIT = 30
 TARGET_CHAT_ID = -1002362736664  # Чат, в котором сохраняем всю историю
 
+# Настройки пула HTTP-соединений для внешних API
+HTTP_POOL_LIMIT = 50
+HTTP_POOL_LIMIT_PER_HOST = 10
+HTTP_DNS_CACHE_TTL = 300  # секунды
+HTTP_KEEPALIVE_TIMEOUT = 60  # секунды
+HTTP_CONNECT_TIMEOUT = 5  # секунды
+HTTP_READ_TIMEOUT = 15  # секунды
+HTTP_TOTAL_TIMEOUT = 30  # секунды
+
+# Параллельные запросы событий матчей
+MATCH_EVENTS_CONCURRENCY = 3
+# Статусы завершённых матчей: их события больше не меняются и хранятся в БД навсегда
+FINISHED_FIXTURE_STATUSES = {"FT", "AET", "PEN", "AWD", "WO"}
+
+# Расписание утреннего сообщения (время Europe/Moscow)
+MORNING_HOUR = 17
+MORNING_MINUTE = 53
+MORNING_PREFETCH_LEAD_MINUTES = 5  # за сколько минут до отправки собираем данные
+MORNING_PREFETCH_TIMEOUT = 60  # секунды на каждый источник при заблаговременном сборе
+MORNING_SEND_TIMEOUT = 5  # секунды на источник, если подготовленного сообщения нет
+MORNING_PREPARED_MAX_AGE = 1800  # секунды, после которых подготовленное сообщение считается устаревшим
+
+# Лимиты исходящих запросов к Telegram Bot API (запросов в секунду и размер пачки)
+TELEGRAM_GLOBAL_RATE = 30
+TELEGRAM_GLOBAL_BURST = 30
+TELEGRAM_GROUP_RATE = 20 / 60
+TELEGRAM_GROUP_BURST = 20
+TELEGRAM_PRIVATE_RATE = 1
+TELEGRAM_PRIVATE_BURST = 3
+TELEGRAM_MAX_RETRIES = 3  # повторов после RetryAfter
+PRIORITY_REPLY = 0
+PRIORITY_REACTION = 1
+
+# Отложенная пакетная запись chat_history
+CHAT_WRITE_BATCH_SIZE = 100
+CHAT_WRITE_FLUSH_INTERVAL = 2  # секунды
+CHAT_WRITE_MAX_PENDING = 10000
+CHAT_WRITE_SHUTDOWN_RETRIES = 5  # попыток дописать буфер при остановке; в работе пакет после временной ошибки повторяется без ограничений
+CHAT_WRITE_STOP_TIMEOUT = 10  # секунды, которые остановка ждёт уже идущий COPY
+CHAT_WRITE_RETRY_BACKOFF = 1  # секунды, удваивается после каждой неудачи
+# Ошибки PostgreSQL при записи chat_history, которые проходят сами; остальные — ошибки в данных, повтор их не исправит
+CHAT_WRITE_TRANSIENT_ERRORS = (
+    asyncpg.PostgresConnectionError,
+    asyncpg.InsufficientResourcesError,
+    asyncpg.OperatorInterventionError,
+    asyncpg.TransactionRollbackError,
+    asyncpg.LockNotAvailableError,
+)
+
+# Хранение chat_history: помесячные партиции, старые удаляются целиком
+CHAT_HISTORY_RETENTION_DAYS = 30  # минимальный срок: партиция удаляется целиком, когда все её сообщения старше срока, поэтому сообщения живут до ~61 дня
+CHAT_HISTORY_PARTITIONS_AHEAD = 1  # сколько будущих месяцев создаём заранее
+MIGRATION_LOCK_KEY = 7270001  # ключ advisory-блокировки на время миграций
+SCHEDULER_LOCK_KEY = 7270002  # задачи планировщика выполняет только держатель этой блокировки
+SCHEDULER_LOCK_RETRY = 30  # секунды между попытками захватить блокировку планировщика и проверками соединения
+WORKER_QUEUE_SIZE = 1000  # обновлений в очереди одного воркера
+WORKER_STOP_TIMEOUT = 30  # секунды на штатную остановку воркера
+ALLOWED_UPDATES = ["message", "callback_query"]
+
+# Кэш контекста AI в памяти: сколько чатов держим одновременно
+CHAT_CONTEXT_CACHE_CHATS = 100
+SEARCH_PAGE_SIZE = 5  # результатов /search на страницу
+SEARCH_SNIPPET_CHARS = 200
+SEARCH_MAX_SESSIONS = 200  # сколько последних запросов /search помним для кнопки «Дальше»
+AI_RETRIEVAL_TOP_K = 3  # сколько старых релевантных сообщений добавляем в контекст AI
+AI_RETRIEVAL_CANDIDATES = 200  # ранжируем только самые свежие совпадения, чтобы частые слова не сканировали всю таблицу
+AI_RETRIEVAL_TIMEOUT = 0.5  # секунды; поиск по истории не должен задерживать ответ
+
+# Кэш ответов внешних API: (время свежести, время отдачи устаревшего значения) в секундах
+CACHE_MAX_ENTRIES = 256
+# Котировки: несколько провайдеров на инструмент, хеджированные запросы и выбор по задержке и ошибкам
+QUOTE_LATENCY_WINDOW = 50  # последних замеров задержки на провайдера
+QUOTE_MIN_SAMPLES = 5  # пока замеров меньше, задержка провайдера считается неизвестной
+QUOTE_HEDGE_PERCENTILE = 0.9  # если провайдер не ответил за этот перцентиль своей задержки, параллельно спрашиваем следующего
+QUOTE_HEDGE_MIN_DELAY = 0.2  # секунды
+QUOTE_HEDGE_DEFAULT_DELAY = 1  # секунды, пока задержка провайдера неизвестна
+QUOTE_ERROR_DECAY = 0.2  # вес последнего запроса в скользящей доле ошибок провайдера
+QUOTE_SHOW_AGE_AFTER = 1800  # котировки старше этого показываем в утреннем сообщении с возрастом
+
+CACHE_TTL = {
+    "weather": (600, 1800),
+    "currency": (900, 3600),
+    "crypto": (120, 600),
+    "team_matches": (300, 1800),
+    "match_events": (120, 600),
+}
+
 # Получение переменных окружения
 def get_env_var(var_name, default=None):
     value = os.getenv(var_name)
@@ -49,6 +243,28 @@ RAPIDAPI_KEY = get_env_var('RAPIDAPI_KEY')
 CHAT_ID = int(get_env_var('CHAT_ID'))
 DATABASE_URL = get_env_var('DATABASE_URL')
 TARGET_USER_ID = int(get_env_var('TARGET_USER_ID', '660949286'))
+AI_STREAMING = get_env_var('AI_STREAMING', 'true').lower() in ('1', 'true', 'yes')  # Потоковые ответы AI
+
+# Режим вебхука: если WEBHOOK_URL задан, Telegram сам присылает обновления вместо long polling.
+# Вебхук обслуживает один экземпляр бота: кэши reset_id и контекста AI живут в памяти процесса,
+# и /reset, принятый другим экземпляром за балансировщиком, они бы не увидели. Масштабируется бот
+# через WORKER_PROCESSES — главный процесс раздаёт обновления воркерам по chat_id
+WEBHOOK_URL = get_env_var('WEBHOOK_URL', '')  # публичный адрес бота, например https://bot.example.com
+WEBHOOK_PATH = get_env_var('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = get_env_var('WEBHOOK_SECRET', '')
+WEBHOOK_DELETE_ON_SHUTDOWN = get_env_var('WEBHOOK_DELETE_ON_SHUTDOWN', 'true').lower() in ('1', 'true', 'yes')
+WEB_SERVER_HOST = get_env_var('WEB_SERVER_HOST', '0.0.0.0')
+# Порт вебхука задаёт платформа. Heroku выдаёт PORT и направляет на него трафик только процессу web,
+# поэтому в режиме вебхука бот запускается как web, а в режиме long polling — как worker (см. Procfile).
+# Без PORT вебхук слушал бы порт, до которого Telegram не достучится, поэтому в этом случае бот не стартует
+WEB_SERVER_PORT = int(get_env_var('PORT')) if WEBHOOK_URL else None
+
+# Эндпоинт /metrics в формате Prometheus; по умолчанию доступен только локально, 0 — выключен
+METRICS_HOST = get_env_var('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(get_env_var('METRICS_PORT', '9100'))
+
+# Больше 1 — главный процесс только принимает обновления и раздаёт их воркерам по chat_id; метрики воркера i на METRICS_PORT + 1 + i
+WORKER_PROCESSES = max(1, int(get_env_var('WORKER_PROCESSES', '1')))
 
 # Константы для ответов из .env
 RESPONSES_SOSAL = json.loads(get_env_var('RESPONSES_SOSAL'))  # Обязательная переменная
@@ -58,217 +274,1568 @@ RESPONSES_SCAMIL = json.loads(get_env_var('RESPONSES_SCAMIL'))  # Обязате
 TEAM_IDS = json.loads(get_env_var('TEAM_IDS'))                # Обязательная переменная
 TARGET_REACTION = ReactionTypeEmoji(emoji=get_env_var('TARGET_REACTION'))  # Обязательная переменная
 
-# Настройка клиента DeepSeek
-deepseek_client = AsyncOpenAI(api_key=DEEPSEEK_API_KEY, base_url="https://api.deepseek.com")
+# Адреса внешних API; переопределяются для локальных заглушек (см. bench_bot.py)
+TELEGRAM_API_URL = get_env_var('TELEGRAM_API_URL', '')  # пусто — официальный https://api.telegram.org
+DEEPSEEK_BASE_URL = get_env_var('DEEPSEEK_BASE_URL', 'https://api.deepseek.com')
+OPENWEATHER_API_URL = get_env_var('OPENWEATHER_API_URL', 'http://api.openweathermap.org/data/2.5')
+CURRENCY_API_URL = get_env_var('CURRENCY_API_URL', 'https://cdn.jsdelivr.net/npm/@fawazahmed0/currency-api@latest/v1')
+CURRENCY_FALLBACK_API_URL = get_env_var('CURRENCY_FALLBACK_API_URL', 'https://latest.currency-api.pages.dev/v1')
+EXCHANGE_RATE_API_URL = get_env_var('EXCHANGE_RATE_API_URL', 'https://open.er-api.com/v6')
+COINGECKO_API_URL = get_env_var('COINGECKO_API_URL', 'https://api.coingecko.com/api/v3')
+BINANCE_API_URL = get_env_var('BINANCE_API_URL', 'https://api.binance.com/api/v3')
+FOOTBALL_API_URL = get_env_var('FOOTBALL_API_URL', 'https://api-football-v1.p.rapidapi.com/v3')
 
-# Класс для всех API-запросов
-class ApiClient:
-    @staticmethod
-    async def get_weather(city):
-        url = f"http://api.openweathermap.org/data/2.5/weather?q={city}&appid={OPENWEATHER_API_KEY}&units=metric&lang=ru"
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        temp = data['main']['temp']
-                        desc = data['weather'][0]['description']
-                        return f"{temp}°C, {desc}"
-                    logger.error(f"Ошибка получения погоды для {city}: {response.status}")
-                    return "Нет данных"
-        except aiohttp.ClientError as e:
-            logger.error(f"Исключение при получении погоды: {e}")
-            return "Нет данных"
+# Каталог, куда партиции chat_history выгружаются перед удалением (history_archive.py); пусто — не архивировать
+ARCHIVE_DIR = get_env_var('ARCHIVE_DIR', '')
 
-    @staticmethod
-    async def get_currency_rates():
-        url = "https://cdn.jsdelivr.net/npm/@fawazahmed0/currency-api@latest/v1/currencies/usd.json"
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        usd_byn = data['usd'].get('byn', 0)
-                        usd_rub = data['usd'].get('rub', 0)
-                        return usd_byn, usd_rub
-                    logger.error(f"Ошибка получения курсов валют: {response.status}")
-                    return 0, 0
-        except aiohttp.ClientError as e:
-            logger.error(f"Исключение при получении курсов валют: {e}")
-            return 0, 0
+# Утреннее сообщение: города для погоды и чаты для рассылки
+DEFAULT_MORNING_CITIES = {
+    "Минск": "Minsk,BY", "Жлобин": "Zhlobin,BY", "Гомель": "Gomel,BY",
+    "Житковичи": "Zhitkovichi,BY", "Шри-Ланка": "Colombo,LK", "Ноябрьск": "Noyabrsk,RU"
+}
+MORNING_CITIES = json.loads(get_env_var('MORNING_CITIES', json.dumps(DEFAULT_MORNING_CITIES)))
+MORNING_CHAT_IDS = json.loads(get_env_var('MORNING_CHAT_IDS', json.dumps([CHAT_ID])))
+
+# Системный промпт не меняется между запросами: DeepSeek кэширует общий префикс
+SYSTEM_PROMPT = "Ты Анатолий Шарий, твоя фамилия Шарий, у тебя есть жена Ольга Шарий. Ты пророссийский журналист, скамер, блогер, эксцентричный пиздец, любишь материться. Отвечай с иронией, надменностью и будь полезным помощником в Telegram-группе."
+
+# Заготовленные ответы при недоступности AI
+AI_BUSY_RESPONSE = "Ошибка, ёбана: слишком много желающих поболтать, подожди немного"
+AI_UNAVAILABLE_RESPONSE = "Ошибка, ёбана: DeepSeek сейчас лежит, попробуй позже"
+AI_FAILED_RESPONSE = "Ошибка, ёбана: не смог ничего родить, спроси ещё раз"
+
+# Ошибки DeepSeek, после которых имеет смысл повторить запрос
+AI_TRANSIENT_ERRORS = (
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+# Таймауты считаются сбоями для размыкателя, но не повторяются: повтор к медленному DeepSeek только дольше держит слот.
+# APITimeoutError — подкласс APIConnectionError, поэтому проверяется первым
+AI_TIMEOUT_ERRORS = (openai.APITimeoutError, asyncio.TimeoutError)
+
+# Настройка клиента DeepSeek: повторы и общий срок запроса задаёт AiDispatcher, а не SDK
+deepseek_client = AsyncOpenAI(
+    api_key=DEEPSEEK_API_KEY,
+    base_url=DEEPSEEK_BASE_URL,
+    max_retries=0,
+    timeout=httpx.Timeout(AI_REQUEST_TIMEOUT, connect=AI_CONNECT_TIMEOUT)
+)
+
+# Метрики в формате Prometheus: счётчики, значения и гистограммы с метками
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Metrics:
+    def __init__(self):
+        self.counters = {}  # name -> {labels: value}
+        self.gauges = {}  # name -> {labels: value}
+        self.histograms = {}  # name -> {labels: [counts по корзинам, сумма, количество]}
 
     @staticmethod
-    async def get_crypto_prices():
-        url = "https://api.coingecko.com/api/v3/simple/price?ids=bitcoin,worldcoin&vs_currencies=usd"
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        btc_price = data.get('bitcoin', {}).get('usd', 0)
-                        wld_price = data.get('worldcoin', {}).get('usd', 0)
-                        return btc_price, wld_price
-                    logger.error(f"Ошибка получения цен криптовалют: {response.status}")
-                    return 0, 0
-        except aiohttp.ClientError as e:
-            logger.error(f"Исключение при получении цен криптовалют: {e}")
-            return 0, 0
+    def _labels(labels):
+        return tuple(sorted((labels or {}).items()))
+
+    def inc(self, name, labels=None, value=1):
+        series = self.counters.setdefault(name, {})
+        key = self._labels(labels)
+        series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, labels=None):
+        self.gauges.setdefault(name, {})[self._labels(labels)] = value
+
+    def observe(self, name, value, labels=None):
+        series = self.histograms.setdefault(name, {})
+        histogram = series.setdefault(self._labels(labels), [[0] * len(METRICS_BUCKETS), 0.0, 0])
+        for index, bound in enumerate(METRICS_BUCKETS):
+            if value <= bound:
+                histogram[0][index] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, labels=None):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, labels)
 
     @staticmethod
-    async def get_team_matches(team_id):
-        url = f"https://api-football-v1.p.rapidapi.com/v3/fixtures?team={team_id}&last=5"
-        headers = {"X-RapidAPI-Key": RAPIDAPI_KEY, "X-RapidAPI-Host": "api-football-v1.p.rapidapi.com"}
+    def _format(name, labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return name
+        escaped = ",".join(
+            f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34)).replace(chr(10), chr(92) + "n")}"'
+            for key, value in pairs
+        )
+        return f"{name}{{{escaped}}}"
+
+    def render(self):
+        lines = []
+        for kind, store in (("counter", self.counters), ("gauge", self.gauges)):
+            for name, series in sorted(store.items()):
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in series.items():
+                    lines.append(f"{self._format(name, labels)} {value}")
+        for name, series in sorted(self.histograms.items()):
+            lines.append(f"# TYPE {name} histogram")
+            for labels, (counts, total, count) in series.items():
+                for bound, bucket_count in zip(METRICS_BUCKETS, counts):
+                    lines.append(f"{self._format(name + '_bucket', labels, [('le', bound)])} {bucket_count}")
+                lines.append(f"{self._format(name + '_bucket', labels, [('le', '+Inf')])} {count}")
+                lines.append(f"{self._format(name + '_sum', labels)} {total}")
+                lines.append(f"{self._format(name + '_count', labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+@contextlib.asynccontextmanager
+async def acquire_connection(pool):
+    # Соединение из пула с учётом времени ожидания свободного соединения
+    start = time.monotonic()
+    async with pool.acquire() as conn:
+        metrics.observe("db_pool_wait_seconds", time.monotonic() - start)
+        yield conn
+
+def log_db_query(record):
+    # Вызывается asyncpg после каждого запроса на соединениях пула
+    metrics.observe("db_query_seconds", record.elapsed)
+    if record.exception is not None:
+        metrics.inc("db_query_errors_total")
+
+async def init_db_connection(conn):
+    conn.add_query_logger(log_db_query)
+
+def record_ai_usage(usage, kind, chat_id=None):
+    # DeepSeek дополнительно отдаёт prompt_cache_hit_tokens и prompt_cache_miss_tokens
+    if usage is None:
+        return
+    labels = {"kind": kind}
+    if chat_id is not None:
+        labels["chat_id"] = chat_id
+    metrics.inc("ai_prompt_tokens_total", labels, usage.prompt_tokens or 0)
+    metrics.inc("ai_completion_tokens_total", labels, usage.completion_tokens or 0)
+    metrics.inc("ai_prompt_cache_hit_tokens_total", labels, getattr(usage, "prompt_cache_hit_tokens", None) or 0)
+    metrics.inc("ai_prompt_cache_miss_tokens_total", labels, getattr(usage, "prompt_cache_miss_tokens", None) or 0)
+
+# TTL-кэш с LRU-вытеснением, stale-while-revalidate и single-flight
+class ResponseCache:
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> (value, fresh_until, stale_until)
+        self.inflight = {}  # key -> asyncio.Task
+        self.hits = 0
+        self.misses = 0
+
+    def _store(self, key, value, ttl, stale_ttl):
+        now = time.monotonic()
+        self.entries[key] = (value, now + ttl, now + stale_ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _fetch(self, key, fetch, ttl, stale_ttl):
+        # Все одновременные запросы по одному ключу ждут одну и ту же задачу
+        task = self.inflight.get(key)
+        if task is None:
+            async def run():
+                try:
+                    value = await fetch()
+                    # None означает ошибку запроса — такие ответы не кэшируем
+                    if value is not None:
+                        self._store(key, value, ttl, stale_ttl)
+                    return value
+                finally:
+                    self.inflight.pop(key, None)
+            task = asyncio.create_task(run())
+            # Фоновое обновление никто не ждёт — помечаем исключение как полученное
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self.inflight[key] = task
+        return task
+
+    async def get_or_fetch(self, key, fetch, ttl, stale_ttl=None):
+        stale_ttl = max(stale_ttl or ttl, ttl)
+        entry = self.entries.get(key)
+        now = time.monotonic()
+        if entry is not None:
+            value, fresh_until, stale_until = entry
+            if now < fresh_until:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return value
+            if now < stale_until:
+                # Отдаём устаревшее значение сразу, а обновляем в фоне
+                self.hits += 1
+                self.entries.move_to_end(key)
+                self._fetch(key, fetch, ttl, stale_ttl)
+                return value
+            del self.entries[key]
+        self.misses += 1
+        # shield: отмена одного из ожидающих не должна отменять общий запрос
+        return await asyncio.shield(self._fetch(key, fetch, ttl, stale_ttl))
+
+# Разбор ответов провайдеров котировок; None — ответ непригоден
+def positive_values(*values):
+    # Котировка годится, только если все значения — положительные числа: нули в чат не отправляем
+    try:
+        values = tuple(float(value) for value in values)
+    except (TypeError, ValueError):
+        return None
+    return values if all(value > 0 for value in values) else None
+
+def parse_currency_api_rates(data):
+    return positive_values(data['usd'].get('byn'), data['usd'].get('rub'))
+
+def parse_er_api_rates(data):
+    if data.get('result') != 'success':
+        return None
+    return positive_values(data['rates'].get('BYN'), data['rates'].get('RUB'))
+
+def parse_coingecko_prices(data):
+    return positive_values(data.get('bitcoin', {}).get('usd'), data.get('worldcoin', {}).get('usd'))
+
+def parse_binance_prices(data):
+    prices = {item['symbol']: item['price'] for item in data}
+    return positive_values(prices.get('BTCUSDT'), prices.get('WLDUSDT'))
+
+class QuoteProvider:
+    def __init__(self, name, url, parse):
+        self.name = name
+        self.url = url
+        self.parse = parse
+        self.latencies = deque(maxlen=QUOTE_LATENCY_WINDOW)  # удачные и прерванные хеджем запросы
+        self.error_rate = 0.0
+
+    def record(self, elapsed, error):
+        # Задержку ошибок не учитываем: быстрый отказ не делает провайдера быстрым
+        if not error:
+            self.latencies.append(elapsed)
+        self.error_rate += QUOTE_ERROR_DECAY * ((1.0 if error else 0.0) - self.error_rate)
+        metrics.set("quote_provider_error_rate", self.error_rate, {"provider": self.name})
+
+    def latency_percentile(self, fraction):
+        if len(self.latencies) < QUOTE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def hedge_delay(self):
+        latency = self.latency_percentile(QUOTE_HEDGE_PERCENTILE)
+        return max(latency, QUOTE_HEDGE_MIN_DELAY) if latency is not None else QUOTE_HEDGE_DEFAULT_DELAY
+
+    def score(self):
+        # Ожидаемое время до удачного ответа: медиана задержки, растянутая долей ошибок
+        median = self.latency_percentile(0.5)
+        expected = median if median is not None else QUOTE_HEDGE_DEFAULT_DELAY
+        return expected / max(1 - self.error_rate, 0.05)
+
+class QuoteSource:
+    def __init__(self, instrument, providers):
+        self.instrument = instrument
+        self.providers = providers
+        self.last_good = None  # (значения, time.time() получения)
+
+    def ranked(self):
+        # sorted устойчив: при равных оценках сохраняется порядок из конфигурации
+        return sorted(self.providers, key=lambda provider: provider.score())
+
+def format_age(seconds):
+    if seconds < 3600:
+        return f"{int(seconds // 60)} мин"
+    if seconds < 86400:
+        return f"{int(seconds // 3600)} ч"
+    return f"{int(seconds // 86400)} дн"
+
+# Класс для всех API-запросов
+class ApiClient:
+    def __init__(self):
+        self.session = None
+        self.host_stats = {}
+        self.cache = ResponseCache()
+        binance_symbols = quote(json.dumps(["BTCUSDT", "WLDUSDT"], separators=(",", ":")))
+        self.quotes = {
+            "currency": QuoteSource("currency", [
+                QuoteProvider("jsdelivr", f"{CURRENCY_API_URL}/currencies/usd.json", parse_currency_api_rates),
+                QuoteProvider("currency-api", f"{CURRENCY_FALLBACK_API_URL}/currencies/usd.json", parse_currency_api_rates),
+                QuoteProvider("er-api", f"{EXCHANGE_RATE_API_URL}/latest/USD", parse_er_api_rates),
+            ]),
+            "crypto": QuoteSource("crypto", [
+                QuoteProvider("coingecko", f"{COINGECKO_API_URL}/simple/price?ids=bitcoin,worldcoin&vs_currencies=usd", parse_coingecko_prices),
+                QuoteProvider("binance", f"{BINANCE_API_URL}/ticker/price?symbols={binance_symbols}", parse_binance_prices),
+            ]),
+        }
+
+    async def start(self):
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=HTTP_TOTAL_TIMEOUT,
+            connect=HTTP_CONNECT_TIMEOUT,
+            sock_read=HTTP_READ_TIMEOUT
+        )
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        logger.info("HTTP-клиент запущен")
+
+    async def close(self):
+        if self.session and not self.session.closed:
+            await self.session.close()
+            logger.info("HTTP-клиент закрыт")
+
+    def _record_latency(self, host, elapsed, error):
+        stats = self.host_stats.setdefault(host, {"requests": 0, "errors": 0, "total_time": 0.0, "max_time": 0.0})
+        stats["requests"] += 1
+        stats["total_time"] += elapsed
+        stats["max_time"] = max(stats["max_time"], elapsed)
+        if error:
+            stats["errors"] += 1
+            metrics.inc("external_api_errors_total", {"host": host})
+        metrics.observe("external_api_request_seconds", elapsed, {"host": host})
+
+    def get_latency_stats(self):
+        # Средняя и максимальная задержка по каждому хосту в миллисекундах
+        return {
+            host: {
+                "requests": stats["requests"],
+                "errors": stats["errors"],
+                "avg_ms": round(stats["total_time"] / stats["requests"] * 1000, 1),
+                "max_ms": round(stats["max_time"] * 1000, 1)
+            }
+            for host, stats in self.host_stats.items()
+        }
+
+    async def _get_json(self, url, headers=None):
+        # Возвращает (status, data); data равно None, если статус не 200
+        host = urlsplit(url).hostname
+        start = time.monotonic()
+        error = True
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers=headers) as response:
-                    if response.status == 200:
-                        return await response.json()
-                    logger.error(f"Ошибка API-Football для команды {team_id}: {response.status}")
+            async with self.session.get(url, headers=headers) as response:
+                data = await response.json() if response.status == 200 else None
+                error = response.status != 200
+                return response.status, data
+        finally:
+            self._record_latency(host, time.monotonic() - start, error)
+
+    async def _cached(self, endpoint, key, fetch):
+        ttl, stale_ttl = CACHE_TTL[endpoint]
+        return await self.cache.get_or_fetch((endpoint,) + key, fetch, ttl, stale_ttl)
+
+    async def get_weather(self, city):
+        weather = await self._cached("weather", (city,), partial(self._fetch_weather, city))
+        return weather if weather is not None else "Нет данных"
+
+    async def get_quote(self, instrument):
+        # (значения, возраст в секундах); если все провайдеры лежат — последнее удачное значение, None — если его не было
+        source = self.quotes[instrument]
+        result = await self._cached(instrument, (), partial(self._fetch_quotes, source))
+        if result is None:
+            return self.last_quote(instrument)
+        values, fetched_at = result
+        return values, time.time() - fetched_at
+
+    def last_quote(self, instrument):
+        source = self.quotes[instrument]
+        if source.last_good is None:
+            return None
+        metrics.inc("quote_stale_served_total", {"instrument": instrument})
+        values, fetched_at = source.last_good
+        return values, time.time() - fetched_at
+
+    async def get_currency_rates(self):
+        # (USD/BYN, USD/RUB) или None
+        result = await self.get_quote("currency")
+        return result[0] if result else None
+
+    async def get_crypto_prices(self):
+        # (BTC, WLD) в долларах или None
+        result = await self.get_quote("crypto")
+        return result[0] if result else None
+
+    async def get_team_matches(self, team_id):
+        return await self._cached("team_matches", (team_id,), partial(self._fetch_team_matches, team_id))
+
+    async def get_match_events(self, fixture_id):
+        return await self._cached("match_events", (fixture_id,), partial(self._fetch_match_events, fixture_id))
+
+    async def _fetch_weather(self, city):
+        url = f"{OPENWEATHER_API_URL}/weather?q={city}&appid={OPENWEATHER_API_KEY}&units=metric&lang=ru"
+        try:
+            status, data = await self._get_json(url)
+            if status == 200:
+                temp = data['main']['temp']
+                desc = data['weather'][0]['description']
+                return f"{temp}°C, {desc}"
+            logger.error(f"Ошибка получения погоды для {city}: {status}")
+            return None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Исключение при получении погоды: {e!r}")
+            return None
+
+    async def _fetch_quote(self, source, provider):
+        start = time.monotonic()
+        try:
+            status, data = await self._get_json(provider.url)
+            values = provider.parse(data) if status == 200 else None
+            if values is None:
+                logger.error(f"Провайдер {provider.name} не отдал котировки «{source.instrument}»: {status}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Исключение при запросе котировок у {provider.name}: {e!r}")
+            values = None
+        except (KeyError, TypeError, AttributeError, ValueError) as e:
+            logger.error(f"Неожиданный ответ {provider.name} с котировками: {e!r}")
+            values = None
+        except asyncio.CancelledError:
+            # Запрос проиграл хеджу: прошедшее время — нижняя оценка задержки провайдера
+            provider.record(time.monotonic() - start, error=False)
+            raise
+        provider.record(time.monotonic() - start, values is None)
+        return values
+
+    async def _fetch_quotes(self, source):
+        # Начинаем с лучшего провайдера. Следующий подключается, если текущий ошибся
+        # или не ответил за свой перцентиль задержки; побеждает первый годный ответ
+        providers = iter(source.ranked())
+        tasks = {}  # задача -> провайдер
+        try:
+            while True:
+                provider = next(providers, None)
+                hedge_delay = None  # провайдеры кончились — ждём оставшиеся запросы
+                if provider is not None:
+                    if tasks:
+                        metrics.inc("quote_hedged_requests_total", {"instrument": source.instrument})
+                    tasks[asyncio.create_task(self._fetch_quote(source, provider))] = provider
+                    hedge_delay = provider.hedge_delay()
+                if not tasks:
+                    logger.error(f"Все провайдеры котировок «{source.instrument}» недоступны")
                     return None
-        except aiohttp.ClientError as e:
-            logger.error(f"Исключение при запросе матчей: {e}")
+                done, _ = await asyncio.wait(tasks, timeout=hedge_delay, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    winner = tasks.pop(task)
+                    values = task.result()
+                    if values is not None:
+                        metrics.inc("quote_provider_wins_total", {"instrument": source.instrument, "provider": winner.name})
+                        source.last_good = (values, time.time())
+                        return source.last_good
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _fetch_team_matches(self, team_id):
+        url = f"{FOOTBALL_API_URL}/fixtures?team={team_id}&last=5"
+        headers = {"X-RapidAPI-Key": RAPIDAPI_KEY, "X-RapidAPI-Host": "api-football-v1.p.rapidapi.com"}
+        try:
+            status, data = await self._get_json(url, headers=headers)
+            if status == 200:
+                return data
+            logger.error(f"Ошибка API-Football для команды {team_id}: {status}")
+            return None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Исключение при запросе матчей: {e!r}")
             return None
 
-    @staticmethod
-    async def get_match_events(fixture_id):
-        url = f"https://api-football-v1.p.rapidapi.com/v3/fixtures/events?fixture={fixture_id}"
+    async def _fetch_match_events(self, fixture_id):
+        url = f"{FOOTBALL_API_URL}/fixtures/events?fixture={fixture_id}"
         headers = {"X-RapidAPI-Key": RAPIDAPI_KEY, "X-RapidAPI-Host": "api-football-v1.p.rapidapi.com"}
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers=headers) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        logger.info(f"События для матча {fixture_id}: {data}")
-                        return data
-                    logger.error(f"Ошибка API-Football для событий матча {fixture_id}: {response.status}")
-                    return None
-        except aiohttp.ClientError as e:
-            logger.error(f"Исключение при запросе событий матча: {e}")
+            status, data = await self._get_json(url, headers=headers)
+            if status == 200:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"События для матча {fixture_id}: {data}")
+                return data
+            logger.error(f"Ошибка API-Football для событий матча {fixture_id}: {status}")
+            return None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Исключение при запросе событий матча: {e!r}")
+            return None
+
+# Буфер отложенной записи сообщений в chat_history через COPY
+class ChatHistoryWriter:
+    def __init__(self, db_pool):
+        self.db_pool = db_pool
+        self.pending = deque()  # записи в порядке CHAT_HISTORY_COLUMNS
+        self.inflight = []  # пакет, который сейчас пишется в БД
+        self.wakeup = asyncio.Event()
+        self.stopping = asyncio.Event()
+        self.flush_task = None
+        self.failed_attempts = 0
+
+    def start(self):
+        self.flush_task = asyncio.create_task(self._run())
+
+    def enqueue(self, record):
+        self.pending.append(record)
+        if len(self.pending) > CHAT_WRITE_MAX_PENDING:
+            self.pending.popleft()
+            logger.error("Буфер chat_history переполнен, самое старое сообщение отброшено")
+        if len(self.pending) >= CHAT_WRITE_BATCH_SIZE:
+            self.wakeup.set()
+
+    def unflushed(self, chat_id, reset_id):
+        return [
+            record for record in itertools.chain(self.inflight, self.pending)
+            if record[0] == chat_id and record[6] == reset_id
+        ]
+
+    async def _run(self):
+        # Останавливается между пакетами по сигналу stopping, а не отменой посреди COPY
+        backoff = CHAT_WRITE_RETRY_BACKOFF
+        while not self.stopping.is_set():
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=CHAT_WRITE_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            if self.stopping.is_set():
+                break
+            if await self.flush():
+                backoff = CHAT_WRITE_RETRY_BACKOFF
+            else:
+                try:
+                    await asyncio.wait_for(self.stopping.wait(), timeout=backoff)
+                except asyncio.TimeoutError:
+                    pass
+                backoff = min(backoff * 2, CHAT_WRITE_FLUSH_INTERVAL * 30)
+
+    def _requeue_inflight(self):
+        self.pending.extendleft(reversed(self.inflight))
+        self.inflight = []
+
+    async def _write(self, conn, records):
+        # Пишет records — начало self.inflight — и убирает их оттуда. При ошибке в данных делит пакет пополам,
+        # пока не останется одна запись: её отбрасываем, чтобы она не держала остальные сообщения
+        try:
+            await conn.copy_records_to_table("chat_history", records=records, columns=CHAT_HISTORY_COLUMNS)
+        except (asyncpg.PostgresError, ValueError) as e:
+            # ValueError — клиентская DataError asyncpg: запись не кодируется для COPY
+            if isinstance(e, CHAT_WRITE_TRANSIENT_ERRORS):
+                raise
+            if len(records) > 1:
+                middle = len(records) // 2
+                await self._write(conn, records[:middle])
+                await self._write(conn, records[middle:])
+                return
+            chat_id, _, message_id = records[0][:3]
+            logger.error(f"Сообщение {message_id} чата {chat_id} отклонено PostgreSQL и отброшено: {e!r}")
+            metrics.inc("chat_history_rejected_total")
+        del self.inflight[:len(records)]
+
+    async def flush(self):
+        # Пишет все накопленные пакеты; при сбое соединения, таймауте или отмене возвращает недописанное в начало буфера.
+        # Такие пакеты не отбрасываются: размер буфера и так ограничен CHAT_WRITE_MAX_PENDING
+        while self.pending:
+            self.inflight = [self.pending.popleft() for _ in range(min(CHAT_WRITE_BATCH_SIZE, len(self.pending)))]
+            batch_size = len(self.inflight)
+            try:
+                async with acquire_connection(self.db_pool) as conn:
+                    await self._write(conn, list(self.inflight))
+            except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError, asyncio.TimeoutError) as e:
+                self.failed_attempts += 1
+                logger.error(f"Ошибка записи пакета chat_history ({len(self.inflight)} сообщений, попытка {self.failed_attempts}): {e!r}")
+                self._requeue_inflight()
+                return False
+            except asyncio.CancelledError:
+                self._requeue_inflight()
+                raise
+            logger.debug(f"Записан пакет chat_history: {batch_size} сообщений")
+            metrics.inc("chat_history_batches_total")
+            self.failed_attempts = 0
+        return True
+
+    async def close(self):
+        # Даём фоновой задаче дописать текущий пакет; зависший COPY отменяем, пакет при этом возвращается в буфер
+        self.stopping.set()
+        self.wakeup.set()
+        if self.flush_task and not self.flush_task.done():
+            try:
+                await asyncio.wait_for(self.flush_task, timeout=CHAT_WRITE_STOP_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.error(f"Запись пакета chat_history не завершилась за {CHAT_WRITE_STOP_TIMEOUT} с, прерываем")
+        # Дописываем остаток буфера перед остановкой
+        for attempt in range(CHAT_WRITE_SHUTDOWN_RETRIES):
+            if await self.flush():
+                break
+            if attempt + 1 < CHAT_WRITE_SHUTDOWN_RETRIES:
+                await asyncio.sleep(CHAT_WRITE_RETRY_BACKOFF)
+        if self.pending:
+            logger.error(f"При остановке не записано сообщений chat_history: {len(self.pending)}")
+
+# Кольцевые буферы последних сообщений по чатам с LRU-вытеснением неактивных чатов
+class ChatContextCache:
+    def __init__(self, max_chats=CHAT_CONTEXT_CACHE_CHATS, limit=CHAT_HISTORY_LIMIT):
+        self.max_chats = max_chats
+        self.limit = limit
+        self.chats = OrderedDict()  # chat_id -> (reset_id, deque[(created_at, role, content)])
+
+    def get(self, chat_id, reset_id):
+        entry = self.chats.get(chat_id)
+        if entry is None or entry[0] != reset_id:
+            return None
+        self.chats.move_to_end(chat_id)
+        return entry[1]
+
+    def fill(self, chat_id, reset_id, turns):
+        self.chats[chat_id] = (reset_id, deque(turns, maxlen=self.limit))
+        self.chats.move_to_end(chat_id)
+        while len(self.chats) > self.max_chats:
+            self.chats.popitem(last=False)
+
+    def append(self, chat_id, reset_id, turn):
+        # Незагруженные чаты не трогаем: они подтянутся из БД при первом обращении.
+        # Возвращает вытесненное из буфера сообщение, если буфер был полон
+        turns = self.get(chat_id, reset_id)
+        if turns is None:
+            return None
+        evicted = turns[0] if len(turns) == turns.maxlen else None
+        turns.append(turn)
+        return evicted
+
+    def invalidate(self, chat_id):
+        self.chats.pop(chat_id, None)
+
+# Миграции схемы БД; имена и границы партиций chat_history задаёт history_archive
+async def get_chat_history_partitions(conn):
+    # Возвращает {имя партиции: начало месяца} для всех партиций chat_history
+    rows = await conn.fetch(
+        """
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = 'chat_history'
+        """
+    )
+    partitions = {}
+    for row in rows:
+        try:
+            month = datetime.strptime(row['relname'], "chat_history_%Y_%m").replace(tzinfo=timezone.utc)
+        except ValueError:
+            continue
+        partitions[row['relname']] = month
+    return partitions
+
+async def ensure_chat_history_partitions(conn, since=None):
+    # Создаёт недостающие партиции от месяца since до текущего месяца + CHAT_HISTORY_PARTITIONS_AHEAD
+    existing = await get_chat_history_partitions(conn)
+    month = month_start(since or datetime.now(timezone.utc))
+    last = month_start(datetime.now(timezone.utc))
+    for _ in range(CHAT_HISTORY_PARTITIONS_AHEAD):
+        last = next_month(last)
+    while month <= last:
+        name = chat_history_partition_name(month)
+        if name not in existing:
+            await create_chat_history_partition(conn, month)
+            logger.info(f"Создана партиция {name}")
+        month = next_month(month)
+
+async def ensure_chat_history_partitions_locked(conn):
+    # Воркеры и экземпляры бота создают партиции одновременно: блокировка не даёт им столкнуться на CREATE TABLE
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock($1)", MIGRATION_LOCK_KEY)
+        await ensure_chat_history_partitions(conn)
+
+async def migration_001_base_tables(conn):
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS chat_history (
+            id SERIAL PRIMARY KEY,
+            chat_id BIGINT,
+            user_id BIGINT,
+            message_id BIGINT,
+            role TEXT,
+            content TEXT CHECK (LENGTH(content) <= 4000),
+            timestamp DOUBLE PRECISION,
+            reset_id INTEGER DEFAULT 0
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS chat_reset_ids (
+            chat_id BIGINT PRIMARY KEY,
+            reset_id INTEGER DEFAULT 0
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS fixture_events (
+            fixture_id BIGINT PRIMARY KEY,
+            status TEXT,
+            events JSONB,
+            updated_at TIMESTAMPTZ DEFAULT NOW()
+        )
+    """)
+
+async def migration_002_partition_chat_history(conn):
+    # Переносим chat_history на помесячные партиции по created_at (timestamptz)
+    await conn.execute("ALTER TABLE chat_history RENAME TO chat_history_legacy")
+    await conn.execute("""
+        CREATE TABLE chat_history (
+            id BIGINT GENERATED BY DEFAULT AS IDENTITY,
+            chat_id BIGINT NOT NULL,
+            user_id BIGINT,
+            message_id BIGINT,
+            role TEXT,
+            content TEXT CHECK (LENGTH(content) <= 4000),
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            reset_id INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+    """)
+    # content в индекс не включаем: до 4000 символов не помещается в строку btree-индекса
+    await conn.execute("""
+        CREATE INDEX idx_chat_history_context
+        ON chat_history (chat_id, reset_id, created_at DESC)
+        INCLUDE (message_id, role)
+    """)
+    oldest = await conn.fetchval("SELECT to_timestamp(MIN(timestamp)) FROM chat_history_legacy")
+    await ensure_chat_history_partitions(conn, since=oldest)
+    await conn.execute("""
+        INSERT INTO chat_history (chat_id, user_id, message_id, role, content, created_at, reset_id)
+        SELECT chat_id, user_id, message_id, role, content, to_timestamp(timestamp), COALESCE(reset_id, 0)
+        FROM chat_history_legacy
+        WHERE chat_id IS NOT NULL AND timestamp IS NOT NULL
+    """)
+    await conn.execute("DROP TABLE chat_history_legacy")
+
+async def migration_003_chat_history_search(conn):
+    # Полнотекстовый поиск: русская и английская морфология в одном векторе, GIN-индекс на каждой партиции
+    await conn.execute("""
+        ALTER TABLE chat_history ADD COLUMN search_vector TSVECTOR
+        GENERATED ALWAYS AS (
+            to_tsvector('russian', COALESCE(content, '')) || to_tsvector('english', COALESCE(content, ''))
+        ) STORED
+    """)
+    await conn.execute("CREATE INDEX idx_chat_history_search ON chat_history USING GIN (search_vector)")
+
+# (версия, описание, функция); новые миграции добавляются только в конец
+MIGRATIONS = [
+    (1, "Базовые таблицы", migration_001_base_tables),
+    (2, "Партиционирование chat_history по месяцам", migration_002_partition_chat_history),
+    (3, "Полнотекстовый поиск по chat_history", migration_003_chat_history_search),
+]
+
+# Запрос пользователя превращается в tsquery для обеих конфигураций; $2 — текст запроса
+SEARCH_TSQUERY = "(websearch_to_tsquery('russian', $2) || websearch_to_tsquery('english', $2))"
+# Для подмешивания в контекст AI достаточно совпадения любого слова вопроса
+RETRIEVAL_TSQUERY = (
+    "(replace(plainto_tsquery('russian', $2)::text, '&', '|')::tsquery"
+    " || replace(plainto_tsquery('english', $2)::text, '&', '|')::tsquery)"
+)
+
+async def search_chat_history(conn, chat_id, query, after=None, limit=SEARCH_PAGE_SIZE):
+    # Keyset-пагинация от новых к старым: after — (created_at, id) последнего показанного сообщения
+    after_created_at, after_id = after or (None, None)
+    return await conn.fetch(
+        f"""
+        SELECT id, created_at, role, content
+        FROM chat_history
+        WHERE chat_id = $1
+          AND search_vector @@ {SEARCH_TSQUERY}
+          AND ($3::timestamptz IS NULL OR (created_at, id) < ($3, $4))
+        ORDER BY created_at DESC, id DESC
+        LIMIT $5
+        """,
+        chat_id, query, after_created_at, after_id, limit
+    )
+
+async def retrieve_relevant_messages(conn, chat_id, query, reset_id, before, limit=AI_RETRIEVAL_TOP_K):
+    # Самые релевантные вопросу сообщения старше окна истории, в хронологическом порядке
+    rows = await conn.fetch(
+        f"""
+        SELECT created_at, role, content
+        FROM (
+            SELECT created_at, role, content, search_vector
+            FROM chat_history
+            WHERE chat_id = $1
+              AND reset_id = $3
+              AND created_at < $4
+              AND search_vector @@ {RETRIEVAL_TSQUERY}
+            ORDER BY created_at DESC
+            LIMIT $6
+        ) candidates
+        ORDER BY ts_rank_cd(search_vector, {RETRIEVAL_TSQUERY}) DESC, created_at DESC
+        LIMIT $5
+        """,
+        chat_id, query, reset_id, before, limit, AI_RETRIEVAL_CANDIDATES
+    )
+    return sorted(rows, key=lambda row: row['created_at'])
+
+async def get_schema_version(conn):
+    try:
+        return await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+    except asyncpg.UndefinedTableError:
+        return 0
+
+async def run_migrations(conn):
+    latest = MIGRATIONS[-1][0]
+    if await get_schema_version(conn) >= latest:
+        return
+    # Блокировка не даёт двум экземплярам бота мигрировать одновременно
+    await conn.execute("SELECT pg_advisory_lock($1)", MIGRATION_LOCK_KEY)
+    try:
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at TIMESTAMPTZ DEFAULT NOW()
+            )
+        """)
+        current = await get_schema_version(conn)
+        for version, description, migrate in MIGRATIONS:
+            if version <= current:
+                continue
+            async with conn.transaction():
+                await migrate(conn)
+                await conn.execute(
+                    "INSERT INTO schema_migrations (version, description) VALUES ($1, $2)",
+                    version, description
+                )
+            logger.info(f"Применена миграция {version}: {description}")
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_KEY)
+
+# Локальная оценка числа токенов без обращения к токенизатору DeepSeek
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+def estimate_tokens(text):
+    # Слова считаем по ~3 символа на токен, знаки препинания — по токену, плюс служебные токены сообщения
+    return sum((len(token) + 2) // 3 for token in TOKEN_PATTERN.findall(text)) + 4
+
+# Сборка контекста AI в пределах бюджета токенов со сводкой выпавшей истории
+class ContextBuilder:
+    def __init__(self, token_budget=AI_HISTORY_TOKEN_BUDGET, block_turns=AI_HISTORY_BLOCK_TURNS, summarize=None):
+        self.token_budget = token_budget
+        self.block_turns = block_turns
+        # В боте сводки идут через AiDispatcher.summarize, чтобы делить с ответами лимит и размыкатель
+        self.summarize = summarize or AiHandler.summarize
+        self.summaries = {}  # chat_id -> {"reset_id", "summary", "until", "pending", "window_start"}
+        self.refresh_tasks = {}  # chat_id -> asyncio.Task
+
+    def _state(self, chat_id, reset_id):
+        state = self.summaries.get(chat_id)
+        if state is None or state["reset_id"] != reset_id:
+            state = {"reset_id": reset_id, "summary": "", "until": None, "pending": [], "window_start": None}
+            self.summaries[chat_id] = state
+        return state
+
+    def add_dropped(self, chat_id, reset_id, turns):
+        # Запоминаем выпавшие из окна сообщения, которых ещё нет в сводке
+        state = self._state(chat_id, reset_id)
+        for turn in turns:
+            last = state["pending"][-1][0] if state["pending"] else state["until"]
+            if last is None or turn[0] > last:
+                state["pending"].append(turn)
+        # Если AI долго недоступен, не копим выпавшие сообщения бесконечно
+        del state["pending"][:-AI_SUMMARY_BATCH_TURNS * 5]
+        if len(state["pending"]) >= AI_SUMMARY_BATCH_TURNS:
+            self._schedule_refresh(chat_id, state)
+
+    def _schedule_refresh(self, chat_id, state):
+        task = self.refresh_tasks.get(chat_id)
+        if task is not None and not task.done():
+            return
+        self.refresh_tasks[chat_id] = asyncio.create_task(self._refresh_summary(chat_id, state))
+
+    async def _refresh_summary(self, chat_id, state):
+        turns = list(state["pending"])
+        try:
+            summary = await self.summarize(state["summary"], [(role, content) for _, role, content in turns])
+        except Exception as e:
+            logger.error(f"Ошибка обновления сводки контекста для чата {chat_id}: {e}")
+            return
+        if self.summaries.get(chat_id) is not state:
+            return  # контекст был сброшен, пока готовилась сводка
+        state["summary"] = summary
+        state["until"] = turns[-1][0]
+        del state["pending"][:len(turns)]
+        logger.info(f"Сводка контекста обновлена для чата {chat_id}: {len(turns)} сообщений")
+
+    def _window_start(self, state, turns, fit_start):
+        # Начало окна стоит на месте, пока окно влезает в бюджет и буфер, а потом сдвигается сразу на блок:
+        # так запросы к DeepSeek подряд начинаются одинаково и префикс берётся из его кэша
+        anchor = state["window_start"]
+        if anchor is None or not turns or turns[-1][0] < anchor:
+            return fit_start
+        # Если начало окна уже вытеснено из буфера, считаем его стоящим сразу перед буфером
+        index = next((i for i, turn in enumerate(turns) if turn[0] >= anchor), len(turns))
+        if turns[index][0] != anchor:
+            index -= 1
+        if index >= fit_start:
+            return index
+        start = index + -(-(fit_start - index) // self.block_turns) * self.block_turns
+        return start if start < len(turns) else fit_start
+
+    def window_start(self, chat_id, reset_id):
+        # created_at самого старого сообщения в окне последнего запроса
+        state = self.summaries.get(chat_id)
+        if state is None or state["reset_id"] != reset_id:
             return None
+        return state["window_start"]
+
+    def build(self, chat_id, reset_id, turns):
+        # Берём самые новые сообщения, пока они помещаются в бюджет; остальные уходят в сводку
+        used = 0
+        fit_start = len(turns)
+        for _, _, content in reversed(turns):
+            cost = estimate_tokens(content)
+            if used + cost > self.token_budget:
+                break
+            used += cost
+            fit_start -= 1
+        state = self._state(chat_id, reset_id)
+        start = self._window_start(state, turns, fit_start)
+        state["window_start"] = turns[start][0] if start < len(turns) else None
+        if start:
+            self.add_dropped(chat_id, reset_id, turns[:start])
+        messages = [{"role": role, "content": content} for _, role, content in turns[start:]]
+        summary = state["summary"]
+        if summary:
+            messages.insert(0, {"role": "system", "content": f"Краткое содержание более ранней переписки: {summary}"})
+        return messages
+
+# Ведро токенов для ограничения частоты запросов
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def delay(self):
+        # Сколько секунд ждать до следующего свободного токена
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = self.blocked_delay()
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def blocked_delay(self):
+        # Сколько секунд ещё действует пауза после RetryAfter
+        return max(self.blocked_until - time.monotonic(), 0)
+
+    def consume(self):
+        self.tokens -= 1
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+# Очередь исходящих запросов к Telegram: все вызовы self.bot проходят через неё как middleware сессии.
+# У каждого чата своя очередь ожидающих, общий порядок задаёт только глобальный лимит:
+# чат, упёршийся в свой лимит, пропускается и не задерживает ответы в другие чаты
+class OutboundLimiter(BaseRequestMiddleware):
+    def __init__(self):
+        self.waiters = {}  # (chat_id, расходует ли лимит чата) -> куча (приоритет, номер, future)
+        self.sequence = itertools.count()
+        self.wakeup = asyncio.Event()
+        # Глобальный лимит Telegram общий для всего бота, поэтому воркеры делят его поровну
+        self.global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE / WORKER_PROCESSES, max(1, TELEGRAM_GLOBAL_BURST // WORKER_PROCESSES))
+        self.chat_buckets = {}
+        self.worker_task = None
+
+    @property
+    def depth(self):
+        return sum(len(waiters) for waiters in self.waiters.values())
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 1000:
+                # Забываем чаты, чьи вёдра уже полностью восстановились
+                self.chat_buckets = {key: value for key, value in self.chat_buckets.items() if value.delay() > 0 or value.tokens < value.capacity}
+            if chat_id < 0:
+                bucket = TokenBucket(TELEGRAM_GROUP_RATE, TELEGRAM_GROUP_BURST)
+            else:
+                bucket = TokenBucket(TELEGRAM_PRIVATE_RATE, TELEGRAM_PRIVATE_BURST)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _next_ready(self):
+        # Лучший по (приоритет, номер) запрос среди чатов, чьи вёдра готовы, и сколько ждать ближайшего неготового
+        best, wait = None, None
+        for key, waiters in list(self.waiters.items()):
+            while waiters and waiters[0][2].done():
+                heapq.heappop(waiters)  # ожидающий отменён
+            if not waiters:
+                del self.waiters[key]
+                continue
+            chat_id, counted = key
+            bucket = self._chat_bucket(chat_id)
+            delay = bucket.delay() if counted else bucket.blocked_delay()
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+            elif best is None or waiters[0][:2] < self.waiters[best][0][:2]:
+                best = key
+        return best, wait
+
+    async def _run(self):
+        while True:
+            self.wakeup.clear()
+            key, wait = self._next_ready()
+            if key is None:
+                # Все чаты ждут своих лимитов: спим до ближайшего или до нового запроса
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            global_wait = self.global_bucket.delay()
+            if global_wait > 0:
+                # За это время может прийти запрос важнее, поэтому после сна выбираем заново
+                await asyncio.sleep(global_wait)
+                continue
+            _, _, granted = heapq.heappop(self.waiters[key])
+            chat_id, counted = key
+            self.global_bucket.consume()
+            if counted:
+                self._chat_bucket(chat_id).consume()
+            granted.set_result(None)
+
+    async def _acquire(self, chat_id, counted, priority):
+        if self.worker_task is None or self.worker_task.done():
+            self.worker_task = asyncio.create_task(self._run())
+        granted = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters.setdefault((chat_id, counted), []), (priority, next(self.sequence), granted))
+        self.wakeup.set()
+        await granted
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if not isinstance(chat_id, int):
+            # get_me, set_webhook и прочие служебные вызовы не ограничиваем
+            return await make_request(bot, method)
+        is_reaction = isinstance(method, SetMessageReaction)
+        # Реакции не расходуют лимит сообщений чата и пропускают ответы вперёд, но паузу RetryAfter чата соблюдают
+        priority = PRIORITY_REACTION if is_reaction else PRIORITY_REPLY
+        for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+            await self._acquire(chat_id, not is_reaction, priority)
+            try:
+                return await make_request(bot, method)
+            except aiogram.exceptions.TelegramRetryAfter as e:
+                if attempt == TELEGRAM_MAX_RETRIES:
+                    raise
+                logger.warning(f"Telegram просит подождать {e.retry_after} с перед {type(method).__name__} в чате {chat_id}")
+                self._chat_bucket(chat_id).block(e.retry_after)
+
+    async def close(self):
+        if self.worker_task and not self.worker_task.done():
+            self.worker_task.cancel()
+            try:
+                await self.worker_task
+            except asyncio.CancelledError:
+                pass
 
 # Класс для работы с AI
 class AiHandler:
     @staticmethod
-    async def get_ai_response(chat_history, query):
-        try:
-            messages = [
-                {"role": "system", "content": f"Ты Анатолий Шарий, твоя фамилия Шарий, у тебя есть жена Ольга Шарий. Ты пророссийский журналист, скамер, блогер, эксцентричный пиздец, любишь материться. Сегодня {datetime.now().strftime('%Y-%m-%d')}. Отвечай с иронией, надменностью и будь полезным помощником в Telegram-группе."}
-            ] + chat_history + [{"role": "user", "content": query}]
-            response = await deepseek_client.chat.completions.create(
+    def build_messages(chat_history, query):
+        # Неизменная часть идёт первой, дата — в самом конце, чтобы не ломать кэш префикса DeepSeek
+        return [{"role": "system", "content": SYSTEM_PROMPT}] + chat_history + [
+            {"role": "system", "content": f"Сегодня {datetime.now().strftime('%Y-%m-%d')}."},
+            {"role": "user", "content": query}
+        ]
+
+    @staticmethod
+    async def stream_ai_response(chat_history, query, chat_id=None):
+        # Асинхронный генератор фрагментов ответа по мере их генерации.
+        # Пока запрос ждёт в очереди DeepSeek, тот шлёт keep-alive и таймаут чтения не срабатывает,
+        # поэтому каждое ожидание фрагмента ограничено общим сроком AI_REQUEST_TIMEOUT.
+        # Срок не охватывает yield: отмена не должна прилетать в код, который читает генератор
+        deadline = asyncio.get_running_loop().time() + AI_REQUEST_TIMEOUT
+        async with asyncio.timeout_at(deadline):
+            stream = await deepseek_client.chat.completions.create(
                 model="deepseek-chat",
-                messages=messages,
+                messages=AiHandler.build_messages(chat_history, query),
                 max_tokens=MAX_TOKENS,
-                temperature=AI_TEMPERATURE
+                temperature=AI_TEMPERATURE,
+                stream=True,
+                stream_options={"include_usage": True}
             )
-            return response.choices[0].message.content
-        except Exception as e:
-            logger.error(f"Ошибка при получении ответа от AI: {e}")
-            return f"Ошибка, ёбана: {str(e)}"
+        async with stream:
+            chunks = aiter(stream)
+            while True:
+                async with asyncio.timeout_at(deadline):
+                    chunk = await anext(chunks, None)
+                if chunk is None:
+                    return
+                if chunk.usage is not None:
+                    record_ai_usage(chunk.usage, "chat", chat_id)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+    @staticmethod
+    async def summarize(previous_summary, turns):
+        dialogue = "\n".join(f"{role}: {content}" for role, content in turns)
+        response = await deepseek_client.chat.completions.create(
+            model="deepseek-chat",
+            messages=[
+                {"role": "system", "content": "Ты сжимаешь историю переписки Telegram-группы. Сохрани факты, имена, договорённости и темы, без оценок. Пиши кратко, на русском."},
+                {"role": "user", "content": f"Текущее краткое содержание:\n{previous_summary or 'пока пусто'}\n\nНовые сообщения:\n{dialogue}\n\nВерни обновлённое краткое содержание."}
+            ],
+            max_tokens=AI_SUMMARY_MAX_TOKENS,
+            temperature=0.3
+        )
+        record_ai_usage(response.usage, "summary")
+        return response.choices[0].message.content.strip()
+
+    @staticmethod
+    async def get_ai_response(chat_history, query, chat_id=None):
+        messages = AiHandler.build_messages(chat_history, query)
+        response = await deepseek_client.chat.completions.create(
+            model="deepseek-chat",
+            messages=messages,
+            max_tokens=MAX_TOKENS,
+            temperature=AI_TEMPERATURE
+        )
+        record_ai_usage(response.usage, "chat", chat_id)
+        return response.choices[0].message.content
+
+class AiUnavailableError(Exception):
+    """AI-запрос отклонён без обращения к DeepSeek; текст исключения — ответ пользователю."""
+
+# Размыкатель: после серии сбоев DeepSeek временно отклоняем запросы сразу
+class CircuitBreaker:
+    def __init__(self, threshold=AI_BREAKER_THRESHOLD, cooldown=AI_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_started_at = None
+
+    def check(self):
+        if self.opened_at is None:
+            return
+        now = time.monotonic()
+        if now - self.opened_at < self.cooldown:
+            raise AiUnavailableError(AI_UNAVAILABLE_RESPONSE)
+        # Полуоткрытое состояние: пропускаем один пробный запрос; зависший пробный не держит размыкатель вечно
+        if self.trial_started_at is not None and now - self.trial_started_at < self.cooldown:
+            raise AiUnavailableError(AI_UNAVAILABLE_RESPONSE)
+        self.trial_started_at = now
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_started_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.trial_started_at is not None or self.failures >= self.threshold:
+            if self.opened_at is None:
+                logger.error(f"DeepSeek недоступен, запросы отклоняются {self.cooldown} с")
+            self.opened_at = time.monotonic()
+            self.trial_started_at = None
+
+# Допуск запросов к AI: общий лимит, очередь, объединение запросов чата, повторы и размыкатель
+class AiDispatcher:
+    def __init__(self):
+        self.semaphore = asyncio.Semaphore(AI_MAX_CONCURRENCY)
+        self.waiting = 0
+        self.chat_locks = {}  # chat_id -> asyncio.Lock, один запрос к AI на чат за раз
+        self.pending = {}  # chat_id -> вопросы, ещё не отправленные в AI
+        self.breaker = CircuitBreaker()
+
+    def join(self, chat_id, query):
+        # Пока запрос чата ждёт своей очереди, новые вопросы из чата присоединяются к нему.
+        # Возвращает True, если вызывающий должен сам выполнить запрос
+        batch = self.pending.get(chat_id)
+        if batch is not None:
+            batch.append(query)
+            return False
+        self.pending[chat_id] = [query]
+        return True
+
+    def take_batch(self, chat_id):
+        return "\n".join(self.pending.pop(chat_id, []))
+
+    @contextlib.asynccontextmanager
+    async def admit(self, chat_id):
+        try:
+            if self.waiting >= AI_MAX_QUEUE:
+                raise AiUnavailableError(AI_BUSY_RESPONSE)
+            self.breaker.check()
+        except AiUnavailableError:
+            self.pending.pop(chat_id, None)
+            raise
+        lock = self.chat_locks.setdefault(chat_id, asyncio.Lock())
+        self.waiting += 1
+        try:
+            await lock.acquire()
+            try:
+                await self.semaphore.acquire()
+            except BaseException:
+                lock.release()
+                raise
+        except BaseException:
+            # Иначе следующие вопросы чата присоединялись бы к пачке, которую никто не отправит
+            self.pending.pop(chat_id, None)
+            raise
+        finally:
+            self.waiting -= 1
+        try:
+            yield
+        finally:
+            self.semaphore.release()
+            lock.release()
+
+    async def _backoff(self, attempt, error):
+        delay = AI_RETRY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5)
+        logger.warning(f"Временная ошибка DeepSeek ({error!r}), повтор через {delay:.1f} с")
+        await asyncio.sleep(delay)
+
+    async def complete(self, chat_history, query, chat_id=None):
+        for attempt in range(AI_MAX_RETRIES + 1):
+            self.breaker.check()
+            try:
+                # DeepSeek держит соединение пустыми строками, пока ответ не готов: нужен общий срок, а не таймаут чтения
+                response = await asyncio.wait_for(AiHandler.get_ai_response(chat_history, query, chat_id), AI_REQUEST_TIMEOUT)
+            except AI_TIMEOUT_ERRORS:
+                self.breaker.record_failure()
+                raise
+            except AI_TRANSIENT_ERRORS as e:
+                self.breaker.record_failure()
+                if attempt == AI_MAX_RETRIES:
+                    raise
+                await self._backoff(attempt, e)
+                continue
+            self.breaker.record_success()
+            return response
+
+    async def stream(self, chat_history, query, chat_id=None):
+        # Повторяем запрос, только пока пользователю ещё ничего не показано
+        for attempt in range(AI_MAX_RETRIES + 1):
+            self.breaker.check()
+            started = False
+            try:
+                async for chunk in AiHandler.stream_ai_response(chat_history, query, chat_id):
+                    started = True
+                    yield chunk
+            except AI_TIMEOUT_ERRORS:
+                self.breaker.record_failure()
+                raise
+            except AI_TRANSIENT_ERRORS as e:
+                self.breaker.record_failure()
+                if started or attempt == AI_MAX_RETRIES:
+                    raise
+                await self._backoff(attempt, e)
+                continue
+            self.breaker.record_success()
+            return
+
+    async def summarize(self, previous_summary, turns):
+        # Фоновая сводка занимает общий слот и учитывается размыкателем, но не повторяется:
+        # сообщения, не попавшие в сводку, дождутся следующего обновления
+        self.breaker.check()
+        async with self.semaphore:
+            try:
+                summary = await asyncio.wait_for(AiHandler.summarize(previous_summary, turns), AI_REQUEST_TIMEOUT)
+            except AI_TIMEOUT_ERRORS + AI_TRANSIENT_ERRORS:
+                self.breaker.record_failure()
+                raise
+            self.breaker.record_success()
+            return summary
 
 # Класс для отправки утренних сообщений
 class MorningMessageSender:
-    def __init__(self, bot):
+    def __init__(self, bot, api_client):
         self.bot = bot
+        self.api_client = api_client
+        self.prepared = None  # (текст, время подготовки)
 
-    async def send_morning_message(self):
+    @staticmethod
+    async def _fetch_with_timeout(coro, timeout, source):
+        # Источник, не успевший за timeout, просто выпадает из сообщения
+        try:
+            return await asyncio.wait_for(coro, timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Источник «{source}» не ответил за {timeout} с")
+            return None
+
+    async def build_morning_message(self, timeout):
+        weather_tasks = [
+            self._fetch_with_timeout(self.api_client.get_weather(code), timeout, f"погода {city}")
+            for city, code in MORNING_CITIES.items()
+        ]
+        weather_results, currency, crypto = await asyncio.gather(
+            asyncio.gather(*weather_tasks),
+            self._fetch_with_timeout(self.api_client.get_quote("currency"), timeout, "курсы валют"),
+            self._fetch_with_timeout(self.api_client.get_quote("crypto"), timeout, "криптовалюты")
+        )
+        weather_data = dict(zip(MORNING_CITIES.keys(), weather_results))
+        # Не дождались свежих котировок — показываем последние удачные с их возрастом
+        currency = currency or self.api_client.last_quote("currency")
+        crypto = crypto or self.api_client.last_quote("crypto")
+        usd_byn_rate, usd_rub_rate = currency[0] if currency else (None, None)
+        btc_price_usd, wld_price_usd = crypto[0] if crypto else (None, None)
+
+        btc_price_byn = btc_price_usd * usd_byn_rate if btc_price_usd and usd_byn_rate else 0
+        wld_price_byn = wld_price_usd * usd_byn_rate if wld_price_usd and usd_byn_rate else 0
+        stale_notes = "".join(
+            f"\n⏳ _{name}: данные {format_age(result[1])} назад_"
+            for name, result in (("Курсы валют", currency), ("Криптовалюты", crypto))
+            if result and result[1] > QUOTE_SHOW_AGE_AFTER
+        )
+
+        return (
+            "Родные мои, всем доброе утро и хорошего дня! ❤️\n\n"
+            "*Положняк по погоде:*\n"
+            + "\n".join(f"🌥 *{city}*: {data or 'Нет данных'}" for city, data in weather_data.items()) + "\n\n"
+            "*Положняк по курсам:*\n"
+            + (f"💵 *USD/BYN*: {usd_byn_rate:.2f} BYN\n" if usd_byn_rate else "💵 *USD/BYN*: Нет данных\n")
+            + (f"💵 *USD/RUB*: {usd_rub_rate:.2f} RUB\n" if usd_rub_rate else "💵 *USD/RUB*: Нет данных\n")
+            + (f"₿ *BTC*: ${btc_price_usd:,.2f} USD | {btc_price_byn:,.2f} BYN\n" if btc_price_usd else "₿ *BTC*: Нет данных\n")
+            + (f"🌍 *WLD*: ${wld_price_usd:.2f} USD | {wld_price_byn:.2f} BYN" if wld_price_usd else "🌍 *WLD*: Нет данных")
+            + stale_notes
+        )
+
+    async def prefetch_morning_message(self):
+        # Собираем данные заранее, чтобы отправка ушла точно по расписанию
         logger.info("Подготовка утреннего сообщения")
         try:
-            cities = {
-                "Минск": "Minsk,BY", "Жлобин": "Zhlobin,BY", "Гомель": "Gomel,BY",
-                "Житковичи": "Zhitkovichi,BY", "Шри-Ланка": "Colombo,LK", "Ноябрьск": "Noyabrsk,RU"
-            }
-            weather_tasks = [ApiClient.get_weather(code) for code in cities.values()]
-            weather_results, (usd_byn_rate, usd_rub_rate), (btc_price_usd, wld_price_usd) = await asyncio.gather(
-                asyncio.gather(*weather_tasks, return_exceptions=True),
-                ApiClient.get_currency_rates(),
-                ApiClient.get_crypto_prices()
-            )
-            weather_data = dict(zip(cities.keys(), weather_results))
-
-            btc_price_byn = float(btc_price_usd) * float(usd_byn_rate) if btc_price_usd and usd_byn_rate else 0
-            wld_price_byn = float(wld_price_usd) * float(usd_byn_rate) if wld_price_usd and usd_byn_rate else 0
-
-            message = (
-                "Родные мои, всем доброе утро и хорошего дня! ❤️\n\n"
-                "*Положняк по погоде:*\n"
-                + "\n".join(f"🌥 *{city}*: {data}" for city, data in weather_data.items()) + "\n\n"
-                "*Положняк по курсам:*\n"
-                f"💵 *USD/BYN*: {usd_byn_rate:.2f} BYN\n"
-                f"💵 *USD/RUB*: {usd_rub_rate:.2f} RUB\n"
-                f"₿ *BTC*: ${btc_price_usd:,.2f} USD | {btc_price_byn:,.2f} BYN\n"
-                f"🌍 *WLD*: ${wld_price_usd:.2f} USD | {wld_price_byn:.2f} BYN"
-            )
-            sent_message = await self.bot.send_message(chat_id=CHAT_ID, text=message, parse_mode=types.ParseMode.MARKDOWN)
-            logger.info("Утреннее сообщение отправлено")
-            return sent_message
-        except aiohttp.ClientError as e:
-            logger.error(f"Ошибка при запросе данных: {e}")
-        except aiogram.exceptions.TelegramAPIError as e:
-            logger.error(f"Ошибка отправки сообщения в Telegram: {e}")
+            self.prepared = (await self.build_morning_message(MORNING_PREFETCH_TIMEOUT), time.monotonic())
+            logger.info("Утреннее сообщение подготовлено")
         except ValueError as e:
             logger.error(f"Ошибка форматирования данных: {e}")
 
+    async def send_morning_message(self):
+        try:
+            if self.prepared and time.monotonic() - self.prepared[1] < MORNING_PREPARED_MAX_AGE:
+                message = self.prepared[0]
+            else:
+                logger.warning("Подготовленного утреннего сообщения нет, собираем с коротким таймаутом")
+                message = await self.build_morning_message(MORNING_SEND_TIMEOUT)
+        except ValueError as e:
+            logger.error(f"Ошибка форматирования данных: {e}")
+            return []
+        self.prepared = None
+        sent_messages = []
+        for chat_id in MORNING_CHAT_IDS:
+            try:
+                sent_messages.append(await self.bot.send_message(chat_id=chat_id, text=message, parse_mode=ParseMode.MARKDOWN))
+            except aiogram.exceptions.TelegramAPIError as e:
+                logger.error(f"Ошибка отправки утреннего сообщения в чат {chat_id}: {e}")
+        logger.info(f"Утреннее сообщение отправлено в {len(sent_messages)} из {len(MORNING_CHAT_IDS)} чатов")
+        return sent_messages
+
 # Основной класс бота
+def create_bot():
+    if TELEGRAM_API_URL:
+        return Bot(token=TELEGRAM_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+    return Bot(token=TELEGRAM_TOKEN)
+
+async def set_bot_webhook(bot):
+    await bot.set_webhook(
+        url=f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET or None,
+        allowed_updates=ALLOWED_UPDATES
+    )
+    logger.info(f"Вебхук установлен: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+
+async def delete_bot_webhook(bot):
+    try:
+        await bot.delete_webhook()
+        logger.info("Вебхук удалён")
+    except aiogram.exceptions.TelegramAPIError as e:
+        logger.error(f"Ошибка при удалении вебхука: {e}")
+
+async def health_check(request: web.Request):
+    return web.json_response({"status": "ok", "version": CODE_VERSION})
+
+def create_webhook_app(dp, bot):
+    app = web.Application()
+    app.router.add_get("/health", health_check)
+    # Обновления без правильного X-Telegram-Bot-Api-Secret-Token отклоняются с 401
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET or None,
+        handle_in_background=True
+    ).register(app, path=WEBHOOK_PATH)
+    return app
+
+def create_stop_event():
+    # SIGTERM — штатная остановка на Heroku: сервер вебхука закрывается, и выполняется on_shutdown
+    stopped = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(signum, stopped.set)
+    return stopped
+
+async def run_webhook_server(app, stopped):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEB_SERVER_HOST, WEB_SERVER_PORT)
+    await site.start()
+    logger.info(f"Веб-сервер вебхука слушает {WEB_SERVER_HOST}:{WEB_SERVER_PORT}")
+    try:
+        await stopped.wait()
+    finally:
+        await runner.cleanup()
+
 class BotApp:
-    def __init__(self):
-        self.bot = Bot(token=TELEGRAM_TOKEN)
+    def __init__(self, worker_index=None):
+        self.worker_index = worker_index  # None — единственный процесс, иначе номер воркера в UpdateIngester
+        self.bot = create_bot()
+        self.outbound = OutboundLimiter()
+        self.bot.session.middleware(self.outbound)
         self.dp = Dispatcher()
         self.scheduler = None
+        self.scheduler_task = None
+        self.scheduler_conn = None
         self.morning_sender = None
         self.keep_alive_task = None
         self.db_pool = None
         self.bot_info = None
+        self.api_client = ApiClient()
+        self.reset_ids = {}  # Кэш reset_id по чатам, обновляется при каждом increment_reset_id
+        self.history_writer = None
+        self.context_cache = ChatContextCache()
+        self.ai_dispatcher = AiDispatcher()
+        self.context_builder = ContextBuilder(summarize=self.ai_dispatcher.summarize)
+        self.search_queries = OrderedDict()  # токен -> (chat_id, запрос) для кнопки «Дальше» в /search
+        self.save_locks = {}  # chat_id -> asyncio.Lock
+        self.background_tasks = set()
+        self.background_failures = 0
+        self.metrics_runner = None
 
     async def keep_alive(self):
         while True:
-            logger.info("Бот активен")
+            logger.info(f"Бот активен: фоновых задач {len(self.background_tasks)}, ошибок в фоне {self.background_failures}, исходящая очередь {self.outbound.depth}")
+            latency_stats = self.api_client.get_latency_stats()
+            if latency_stats:
+                logger.info(f"Задержки внешних API: {latency_stats}")
+                logger.info(f"Кэш API: попаданий {self.api_client.cache.hits}, промахов {self.api_client.cache.misses}")
             await asyncio.sleep(300)
 
+    async def archive_partition(self, conn, name, month):
+        # Партицию удаляем, только если архив записан целиком
+        path = os.path.join(ARCHIVE_DIR, f"{name}.jsonl.gz")
+        try:
+            os.makedirs(ARCHIVE_DIR, exist_ok=True)
+            count = await export_chat_history(conn, path, since=month, until=next_month(month))
+        except (OSError, asyncpg.PostgresError) as e:
+            logger.error(f"Не удалось архивировать партицию {name}, она не удалена: {e!r}")
+            return False
+        logger.info(f"Партиция {name} архивирована в {path}: {count} сообщений")
+        return True
+
     async def cleanup_old_messages(self):
+        # Сначала готовим будущие партиции: DEFAULT-партиции нет, и без них запись в новом месяце встанет.
+        # Поэтому этот шаг не зависит от удаления старых партиций, а ошибка одной из них не мешает остальным
         try:
-            async with self.db_pool.acquire() as conn:
-                await conn.execute(
-                    "DELETE FROM chat_history WHERE timestamp < EXTRACT(EPOCH FROM NOW() - INTERVAL '30 days')"
-                )
+            async with acquire_connection(self.db_pool) as conn:
+                await ensure_chat_history_partitions_locked(conn)
+        except asyncpg.PostgresError as e:
+            logger.error(f"Ошибка PostgreSQL при создании партиций chat_history: {e}")
+        try:
+            cutoff = datetime.now(timezone.utc) - timedelta(days=CHAT_HISTORY_RETENTION_DAYS)
+            async with acquire_connection(self.db_pool) as conn:
+                partitions = await get_chat_history_partitions(conn)
+                for name, month in sorted(partitions.items(), key=lambda item: item[1]):
+                    if next_month(month) > cutoff:
+                        continue
+                    if ARCHIVE_DIR and not await self.archive_partition(conn, name, month):
+                        continue
+                    try:
+                        await conn.execute(f"DROP TABLE IF EXISTS {name}")
+                    except asyncpg.PostgresError as e:
+                        logger.error(f"Ошибка PostgreSQL при удалении партиции {name}: {e}")
+                        continue
+                    logger.info(f"Удалена партиция {name}")
             logger.info("Очистка старых сообщений завершена")
         except asyncpg.PostgresError as e:
             logger.error(f"Ошибка PostgreSQL при очистке старых сообщений: {e}")
 
+    def pause_scheduler(self):
+        if self.scheduler.state != STATE_PAUSED:
+            self.scheduler.pause()
+            logger.warning("Планировщик приостановлен до повторного захвата блокировки")
+
+    async def lead_scheduler(self):
+        # Задачи выполняет только держатель advisory-блокировки: один процесс на все воркеры и экземпляры бота.
+        # Блокировка живёт вместе с отдельным соединением; если оно оборвалось, планировщик встаёт на паузу
+        # и возобновляется только после повторного захвата блокировки на новом соединении
+        while True:
+            try:
+                if self.scheduler_conn is None or self.scheduler_conn.is_closed():
+                    self.pause_scheduler()
+                    self.scheduler_conn = await asyncpg.connect(DATABASE_URL)
+                if self.scheduler.state == STATE_PAUSED:
+                    if await self.scheduler_conn.fetchval("SELECT pg_try_advisory_lock($1)", SCHEDULER_LOCK_KEY):
+                        self.scheduler.resume()
+                        logger.info("Планировщик запущен: блокировка захвачена этим процессом")
+                else:
+                    await self.scheduler_conn.execute("SELECT 1")
+            except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError) as e:
+                logger.error(f"Ошибка соединения с блокировкой планировщика: {e!r}")
+                self.pause_scheduler()
+                if self.scheduler_conn is not None:
+                    self.scheduler_conn.terminate()
+                    self.scheduler_conn = None
+            await asyncio.sleep(SCHEDULER_LOCK_RETRY)
+
+    def timed_job(self, name, job):
+        async def run():
+            with metrics.timer("scheduler_job_seconds", {"job": name}):
+                await job()
+        return run
+
+    def timed_handler(self, route, handler):
+        async def run(event):
+            with metrics.timer("bot_handler_seconds", {"route": route}):
+                await handler(event)
+        return run
+
+    async def metrics_endpoint(self, request: web.Request):
+        # Текущие значения снимаются в момент запроса
+        metrics.set("outbound_queue_depth", self.outbound.depth)
+        metrics.set("background_tasks", len(self.background_tasks))
+        metrics.set("background_task_failures", self.background_failures)
+        metrics.set("api_cache_hits", self.api_client.cache.hits)
+        metrics.set("api_cache_misses", self.api_client.cache.misses)
+        metrics.set("ai_waiting_requests", self.ai_dispatcher.waiting)
+        if self.db_pool:
+            metrics.set("db_pool_size", self.db_pool.get_size())
+            metrics.set("db_pool_idle", self.db_pool.get_idle_size())
+        if self.history_writer:
+            metrics.set("chat_history_unflushed", len(self.history_writer.pending))
+        metrics.set("log_records_dropped", log_queue_handler.dropped)
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    def create_metrics_app(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self.metrics_endpoint)
+        return app
+
     async def on_startup(self):
         logger.info(f"Запуск бота версии {CODE_VERSION}")
         self.bot_info = await self.bot.get_me()
-        self.morning_sender = MorningMessageSender(self.bot)
-        self.db_pool = await asyncpg.create_pool(DATABASE_URL)
-        async with self.db_pool.acquire() as conn:
-            # Создаём таблицу chat_history с колонкой reset_id
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS chat_history (
-                    id SERIAL PRIMARY KEY,
-                    chat_id BIGINT,
-                    user_id BIGINT,
-                    message_id BIGINT,
-                    role TEXT,
-                    content TEXT CHECK (LENGTH(content) <= 4000),
-                    timestamp DOUBLE PRECISION,
-                    reset_id INTEGER DEFAULT 0
-                )
-            """)
-            # Создаём таблицу для хранения reset_id для каждого чата
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS chat_reset_ids (
-                    chat_id BIGINT PRIMARY KEY,
-                    reset_id INTEGER DEFAULT 0
-                )
-            """)
-            await conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_history_chat_id ON chat_history (chat_id)")
-            await conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_history_timestamp ON chat_history (timestamp)")
-            await conn.execute("CREATE INDEX IF NOT EXISTS idx_chat_history_reset_id ON chat_history (reset_id)")
+        if WEBHOOK_URL and self.worker_index is None:
+            await set_bot_webhook(self.bot)
+        await self.api_client.start()
+        self.morning_sender = MorningMessageSender(self.bot, self.api_client)
+        self.db_pool = await asyncpg.create_pool(DATABASE_URL, init=init_db_connection)
+        async with acquire_connection(self.db_pool) as conn:
+            await run_migrations(conn)
+            await ensure_chat_history_partitions_locked(conn)
+        self.history_writer = ChatHistoryWriter(self.db_pool)
+        self.history_writer.start()
         self.scheduler = AsyncIOScheduler(timezone=pytz.timezone('Europe/Moscow'))
-        self.scheduler.add_job(self.morning_sender.send_morning_message, trigger=CronTrigger(hour=17, minute=53))
-        self.scheduler.add_job(self.cleanup_old_messages, trigger=CronTrigger(hour=0, minute=0))  # Очистка каждую полночь
-        self.scheduler.start()
-        logger.info("Планировщик запущен")
+        prefetch_at = datetime(2000, 1, 1, MORNING_HOUR, MORNING_MINUTE) - timedelta(minutes=MORNING_PREFETCH_LEAD_MINUTES)
+        self.scheduler.add_job(self.timed_job("morning_prefetch", self.morning_sender.prefetch_morning_message), trigger=CronTrigger(hour=prefetch_at.hour, minute=prefetch_at.minute))
+        self.scheduler.add_job(self.timed_job("morning_send", self.morning_sender.send_morning_message), trigger=CronTrigger(hour=MORNING_HOUR, minute=MORNING_MINUTE))
+        self.scheduler.add_job(self.timed_job("cleanup", self.cleanup_old_messages), trigger=CronTrigger(hour=0, minute=0))  # Очистка каждую полночь
+        self.scheduler.start(paused=True)
+        self.scheduler_task = asyncio.create_task(self.lead_scheduler())
         self.keep_alive_task = asyncio.create_task(self.keep_alive())
+        if METRICS_PORT:
+            port = METRICS_PORT if self.worker_index is None else METRICS_PORT + 1 + self.worker_index
+            self.metrics_runner = web.AppRunner(self.create_metrics_app())
+            await self.metrics_runner.setup()
+            await web.TCPSite(self.metrics_runner, METRICS_HOST, port).start()
+            logger.info(f"Метрики доступны на http://{METRICS_HOST}:{port}/metrics")
 
     async def on_shutdown(self):
         logger.info("Остановка бота")
@@ -278,78 +1845,127 @@ class BotApp:
                 await self.keep_alive_task
             except asyncio.CancelledError:
                 pass
+        if self.metrics_runner:
+            await self.metrics_runner.cleanup()
+        if self.scheduler_task and not self.scheduler_task.done():
+            self.scheduler_task.cancel()
+            try:
+                await self.scheduler_task
+            except asyncio.CancelledError:
+                pass
         if self.scheduler:
             self.scheduler.shutdown()
             logger.info("Планировщик остановлен")
+        if self.scheduler_conn is not None:
+            await self.scheduler_conn.close()  # вместе с соединением отпускается блокировка планировщика
+        if self.background_tasks:
+            await asyncio.wait(self.background_tasks, timeout=10)
+        if self.history_writer:
+            await self.history_writer.close()
+            logger.info("Буфер chat_history сброшен в БД")
         if self.db_pool:
             await self.db_pool.close()
             logger.info("Соединение с PostgreSQL закрыто")
+        await self.api_client.close()
+        if WEBHOOK_URL and WEBHOOK_DELETE_ON_SHUTDOWN and self.worker_index is None:
+            await delete_bot_webhook(self.bot)
+        await self.outbound.close()
         await self.bot.session.close()
         logger.info("Бот остановлен")
 
     async def get_reset_id(self, chat_id):
-        async with self.db_pool.acquire() as conn:
+        reset_id = self.reset_ids.get(chat_id)
+        if reset_id is not None:
+            return reset_id
+        async with acquire_connection(self.db_pool) as conn:
+            # Один запрос: создаём запись с reset_id = 0, если её нет, и возвращаем текущее значение
             reset_id = await conn.fetchval(
-                "SELECT reset_id FROM chat_reset_ids WHERE chat_id = $1",
+                """
+                INSERT INTO chat_reset_ids (chat_id, reset_id)
+                VALUES ($1, 0)
+                ON CONFLICT (chat_id)
+                DO UPDATE SET reset_id = chat_reset_ids.reset_id
+                RETURNING reset_id
+                """,
                 chat_id
             )
-            if reset_id is None:
-                # Если записи нет, создаём с reset_id = 0
-                await conn.execute(
-                    "INSERT INTO chat_reset_ids (chat_id, reset_id) VALUES ($1, 0) ON CONFLICT (chat_id) DO NOTHING",
-                    chat_id
-                )
-                return 0
-            return reset_id
+        self.reset_ids[chat_id] = reset_id
+        return reset_id
 
     async def increment_reset_id(self, chat_id):
-        async with self.db_pool.acquire() as conn:
+        async with acquire_connection(self.db_pool) as conn:
             # Увеличиваем reset_id на 1, если запись существует, или создаём новую
-            await conn.execute(
+            new_reset_id = await conn.fetchval(
                 """
                 INSERT INTO chat_reset_ids (chat_id, reset_id)
                 VALUES ($1, 1)
                 ON CONFLICT (chat_id)
                 DO UPDATE SET reset_id = chat_reset_ids.reset_id + 1
+                RETURNING reset_id
                 """,
                 chat_id
             )
-            new_reset_id = await conn.fetchval(
-                "SELECT reset_id FROM chat_reset_ids WHERE chat_id = $1",
-                chat_id
-            )
-            return new_reset_id
+        self.reset_ids[chat_id] = new_reset_id
+        return new_reset_id
 
     async def get_chat_history(self, chat_id):
-        reset_id = await self.get_reset_id(chat_id)
-        async with self.db_pool.acquire() as conn:
+        reset_id = self.reset_ids.get(chat_id)
+        turns = self.context_cache.get(chat_id, reset_id)
+        if turns is None:
+            reset_id, turns = await self.load_chat_history(chat_id, reset_id)
+            self.context_cache.fill(chat_id, reset_id, turns)
+        return self.context_builder.build(chat_id, reset_id, list(turns))
+
+    async def load_chat_history(self, chat_id, reset_id=None):
+        # Возвращает (reset_id, сообщения). Если reset_id нет в кэше, он определяется подзапросом в том же запросе;
+        # строка с reset_id возвращается, даже когда сообщений нет
+        async with acquire_connection(self.db_pool) as conn:
             rows = await conn.fetch(
                 """
-                SELECT role, content
-                FROM chat_history
-                WHERE chat_id = $1 AND reset_id = $2
-                ORDER BY timestamp DESC
-                LIMIT $3
+                WITH current AS (
+                    SELECT COALESCE($2::integer, (SELECT reset_id FROM chat_reset_ids WHERE chat_id = $1), 0) AS reset_id
+                )
+                SELECT current.reset_id, history.message_id, history.role, history.content, history.created_at
+                FROM current
+                LEFT JOIN LATERAL (
+                    SELECT message_id, role, content, created_at
+                    FROM chat_history
+                    WHERE chat_id = $1 AND reset_id = current.reset_id
+                    ORDER BY created_at DESC
+                    LIMIT $3
+                ) history ON TRUE
                 """,
                 chat_id, reset_id, CHAT_HISTORY_LIMIT
             )
-            return [{"role": row['role'], "content": row['content']} for row in reversed(rows)]
+        reset_id = rows[0]['reset_id']
+        self.reset_ids.setdefault(chat_id, reset_id)
+        history = [(row['created_at'], row['message_id'], row['role'], row['content']) for row in rows if row['created_at'] is not None]
+        # Добавляем ещё не записанные в БД сообщения из буфера
+        stored = {(message_id, role, created_at) for created_at, message_id, role, _ in history}
+        for _, _, message_id, role, content, created_at, _ in self.history_writer.unflushed(chat_id, reset_id):
+            if (message_id, role, created_at) not in stored:
+                history.append((created_at, message_id, role, content))
+        history.sort(key=lambda item: item[0])
+        return reset_id, [(created_at, role, content) for created_at, _, role, content in history[-CHAT_HISTORY_LIMIT:]]
 
     async def save_chat_message(self, chat_id, user_id, message_id, role, content):
+        # Сообщение попадает в буфер и пишется в БД фоновой задачей пакетами
+        created_at = datetime.now(timezone.utc)
         try:
-            content = content.encode('utf-8', 'ignore').decode('utf-8')
+            # PostgreSQL не хранит NUL в тексте: такое сообщение COPY отклонил бы целиком
+            content = content.encode('utf-8', 'ignore').decode('utf-8').replace('\x00', '')
             content = content[:4000] if len(content) > 4000 else content
-            reset_id = await self.get_reset_id(chat_id)
-            logger.info(f"Сохранение сообщения: chat_id={chat_id}, user_id={user_id}, message_id={message_id}, role={role}, reset_id={reset_id}, content={content[:50]}...")
-            async with self.db_pool.acquire() as conn:
-                await conn.execute(
-                    """
-                    INSERT INTO chat_history (chat_id, user_id, message_id, role, content, timestamp, reset_id)
-                    VALUES ($1, $2, $3, $4, $5, $6, $7)
-                    """,
-                    chat_id, user_id, message_id, role, content, datetime.now().timestamp(), reset_id
-                )
-            logger.info(f"Сообщение успешно сохранено: chat_id={chat_id}, user_id={user_id}, message_id={message_id}, role={role}, reset_id={reset_id}")
+            # Блокировка FIFO: сообщения чата попадают в буфер в порядке вызова, даже если reset_id читается из БД
+            async with self.save_locks.setdefault(chat_id, asyncio.Lock()):
+                reset_id = await self.get_reset_id(chat_id)
+                self.history_writer.enqueue((chat_id, user_id, message_id, role, content, created_at, reset_id))
+                evicted = self.context_cache.append(chat_id, reset_id, (created_at, role, content))
+            if evicted is not None:
+                self.context_builder.add_dropped(chat_id, reset_id, [evicted])
+            log_sampled(
+                "Сообщение поставлено в очередь на сохранение",
+                chat_id=chat_id, user_id=user_id, message_id=message_id, role=role, reset_id=reset_id, content=redact(content)
+            )
         except asyncpg.PostgresError as e:
             logger.error(f"Ошибка PostgreSQL при сохранении сообщения: {e}")
             raise
@@ -357,6 +1973,56 @@ class BotApp:
             logger.error(f"Неизвестная ошибка при сохранении сообщения: {e}")
             raise
 
+    async def load_fixture_events(self, fixture_ids):
+        try:
+            async with acquire_connection(self.db_pool) as conn:
+                rows = await conn.fetch(
+                    "SELECT fixture_id, events FROM fixture_events WHERE fixture_id = ANY($1::bigint[])",
+                    fixture_ids
+                )
+            return {row['fixture_id']: json.loads(row['events']) for row in rows}
+        except asyncpg.PostgresError as e:
+            logger.error(f"Ошибка PostgreSQL при загрузке событий матчей: {e}")
+            return {}
+
+    async def store_fixture_events(self, fixture_events):
+        try:
+            async with acquire_connection(self.db_pool) as conn:
+                await conn.executemany(
+                    """
+                    INSERT INTO fixture_events (fixture_id, status, events)
+                    VALUES ($1, $2, $3::jsonb)
+                    ON CONFLICT (fixture_id) DO UPDATE SET status = EXCLUDED.status, events = EXCLUDED.events, updated_at = NOW()
+                    """,
+                    [(fixture_id, status, json.dumps(events)) for fixture_id, status, events in fixture_events]
+                )
+        except asyncpg.PostgresError as e:
+            logger.error(f"Ошибка PostgreSQL при сохранении событий матчей: {e}")
+
+    async def get_fixtures_events(self, fixtures):
+        # События завершённых матчей берём из БД, остальные запрашиваем параллельно
+        statuses = {fixture["fixture"]["id"]: fixture["fixture"].get("status", {}).get("short") for fixture in fixtures}
+        finished_ids = [fixture_id for fixture_id, status in statuses.items() if status in FINISHED_FIXTURE_STATUSES]
+        events_by_fixture = await self.load_fixture_events(finished_ids) if finished_ids else {}
+        missing_ids = [fixture_id for fixture_id in statuses if fixture_id not in events_by_fixture]
+        semaphore = asyncio.Semaphore(MATCH_EVENTS_CONCURRENCY)
+
+        async def fetch_events(fixture_id):
+            async with semaphore:
+                return await self.api_client.get_match_events(fixture_id)
+
+        results = await asyncio.gather(*(fetch_events(fixture_id) for fixture_id in missing_ids))
+        finished_events = []
+        for fixture_id, events_data in zip(missing_ids, results):
+            if not events_data or not events_data.get("response"):
+                continue
+            events_by_fixture[fixture_id] = events_data["response"]
+            if statuses[fixture_id] in FINISHED_FIXTURE_STATUSES:
+                finished_events.append((fixture_id, statuses[fixture_id], events_data["response"]))
+        if finished_events:
+            await self.store_fixture_events(finished_events)
+        return events_by_fixture
+
     async def command_start(self, message: types.Message):
         sent_message = await message.reply(f"Привет, я бот версии {CODE_VERSION}")
         if message.chat.id == TARGET_CHAT_ID:
@@ -370,6 +2036,7 @@ class BotApp:
     async def command_reset(self, message: types.Message):
         chat_id = message.chat.id
         await self.increment_reset_id(chat_id)
+        self.context_cache.invalidate(chat_id)
         sent_message = await message.reply("Контекст для AI сброшен, мудила. Начинаем с чистого листа!")
         if chat_id == TARGET_CHAT_ID:
             await self.save_chat_message(chat_id, self.bot_info.id, sent_message.message_id, "assistant", "Контекст для AI сброшен, мудила. Начинаем с чистого листа!")
@@ -381,14 +2048,16 @@ class BotApp:
             if message.chat.id == TARGET_CHAT_ID:
                 await self.save_chat_message(message.chat.id, self.bot_info.id, sent_message.message_id, "assistant", "Команда не найдена, мудила!")
             return
-        data = await ApiClient.get_team_matches(team_id)
+        data = await self.api_client.get_team_matches(team_id)
         if not data or not data.get("response"):
             sent_message = await message.reply("Не удалось получить данные о матчах. Пиздец какой-то!")
             if message.chat.id == TARGET_CHAT_ID:
                 await self.save_chat_message(message.chat.id, self.bot_info.id, sent_message.message_id, "assistant", "Не удалось получить данные о матчах. Пиздец какой-то!")
             return
+        fixtures = data["response"]
+        events_by_fixture = await self.get_fixtures_events(fixtures)
         response = f"Последние 5 матчей {team_name.upper()}:\n\n"
-        for fixture in data["response"]:
+        for fixture in fixtures:
             fixture_id = fixture["fixture"]["id"]
             home_team = fixture["teams"]["home"]["name"]
             away_team = fixture["teams"]["away"]["name"]
@@ -398,10 +2067,10 @@ class BotApp:
             result_icon = ("🟢" if home_goals > away_goals else "🔴" if home_goals < away_goals else "🟡") \
                 if fixture["teams"]["home"]["id"] == team_id else \
                 ("🟢" if away_goals > home_goals else "🔴" if away_goals < home_goals else "🟡")
-            events_data = await ApiClient.get_match_events(fixture_id)
+            events = events_by_fixture.get(fixture_id)
             goals_str = "Голы: "
-            if events_data and events_data.get("response"):
-                goal_events = [e for e in events_data["response"] if e["type"] == "Goal"]
+            if events is not None:
+                goal_events = [e for e in events if e["type"] == "Goal"]
                 goals_str += ", ".join([f"{e['player']['name']} ({e['time']['elapsed']}')" for e in goal_events]) \
                     if goal_events else "Нет данных о голах"
             else:
@@ -411,7 +2080,170 @@ class BotApp:
         if message.chat.id == TARGET_CHAT_ID:
             await self.save_chat_message(message.chat.id, self.bot_info.id, sent_message.message_id, "assistant", response)
 
+    def format_search_page(self, token, rows):
+        # Лишняя строка в rows означает, что есть следующая страница
+        moscow = pytz.timezone('Europe/Moscow')
+        lines = []
+        for row in rows[:SEARCH_PAGE_SIZE]:
+            content = row['content'] if len(row['content']) <= SEARCH_SNIPPET_CHARS else row['content'][:SEARCH_SNIPPET_CHARS] + "…"
+            author = "бот" if row['role'] == "assistant" else "чат"
+            lines.append(f"{row['created_at'].astimezone(moscow):%d.%m.%Y %H:%M} ({author}): {content}")
+        keyboard = None
+        if len(rows) > SEARCH_PAGE_SIZE:
+            last = rows[SEARCH_PAGE_SIZE - 1]
+            cursor = f"search:{token}:{int(last['created_at'].timestamp() * 1_000_000)}:{last['id']}"
+            keyboard = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="Дальше", callback_data=cursor)]])
+        return "\n\n".join(lines), keyboard
+
+    async def command_search(self, message: types.Message):
+        # Ответ с результатами в историю не сохраняем, иначе старые сообщения начнут находиться дважды
+        query = (message.text or "").partition(" ")[2].strip()
+        if not query:
+            await message.reply("Что искать-то, мудила? Пиши: /search текст")
+            return
+        try:
+            async with acquire_connection(self.db_pool) as conn:
+                rows = await search_chat_history(conn, message.chat.id, query, limit=SEARCH_PAGE_SIZE + 1)
+        except asyncpg.PostgresError as e:
+            logger.error(f"Ошибка PostgreSQL при поиске по истории: {e}")
+            await message.reply("Поиск сломался. Пиздец какой-то!")
+            return
+        if not rows:
+            await message.reply("Ничего не нашёл, хуйню ищешь")
+            return
+        token = f"{random.getrandbits(32):08x}"
+        self.search_queries[token] = (message.chat.id, query)
+        while len(self.search_queries) > SEARCH_MAX_SESSIONS:
+            self.search_queries.popitem(last=False)
+        text, keyboard = self.format_search_page(token, rows)
+        await message.reply(text, reply_markup=keyboard)
+
+    async def search_next_page(self, callback: types.CallbackQuery):
+        _, token, created_at, row_id = callback.data.split(":")
+        session = self.search_queries.get(token)
+        if session is None or callback.message is None:
+            await callback.answer("Поиск устарел, повтори /search")
+            return
+        chat_id, query = session
+        after = (datetime.fromtimestamp(int(created_at) / 1_000_000, timezone.utc), int(row_id))
+        try:
+            async with acquire_connection(self.db_pool) as conn:
+                rows = await search_chat_history(conn, chat_id, query, after=after, limit=SEARCH_PAGE_SIZE + 1)
+        except asyncpg.PostgresError as e:
+            logger.error(f"Ошибка PostgreSQL при поиске по истории: {e}")
+            await callback.answer("Поиск сломался")
+            return
+        if not rows:
+            await callback.answer("Больше ничего нет")
+            return
+        text, keyboard = self.format_search_page(token, rows)
+        await self.bot.edit_message_text(
+            chat_id=callback.message.chat.id,
+            message_id=callback.message.message_id,
+            text=text,
+            reply_markup=keyboard
+        )
+        await callback.answer()
+
+    async def get_relevant_context(self, chat_id, query):
+        # Старые сообщения по теме вопроса идут в конец контекста, чтобы не ломать кэш префикса
+        reset_id = await self.get_reset_id(chat_id)
+        before = self.context_builder.window_start(chat_id, reset_id) or datetime.now(timezone.utc)
+        try:
+            async with acquire_connection(self.db_pool) as conn:
+                rows = await asyncio.wait_for(
+                    retrieve_relevant_messages(conn, chat_id, query, reset_id, before),
+                    AI_RETRIEVAL_TIMEOUT
+                )
+        except (asyncpg.PostgresError, asyncio.TimeoutError) as e:
+            logger.warning(f"Поиск релевантных сообщений для чата {chat_id} не удался: {e!r}")
+            return []
+        if not rows:
+            return []
+        moscow = pytz.timezone('Europe/Moscow')
+        quoted = "\n".join(f"[{row['created_at'].astimezone(moscow):%d.%m.%Y}] {row['role']}: {row['content']}" for row in rows)
+        return [{"role": "system", "content": f"Сообщения из более ранней переписки по теме вопроса:\n{quoted}"}]
+
+    async def edit_streamed_reply(self, sent_message, text):
+        try:
+            await self.bot.edit_message_text(
+                chat_id=sent_message.chat.id,
+                message_id=sent_message.message_id,
+                text=text[:TELEGRAM_MESSAGE_LIMIT]
+            )
+        except aiogram.exceptions.TelegramBadRequest as e:
+            # Telegram отклоняет правку, если текст не изменился
+            logger.debug(f"Правка сообщения пропущена: {e}")
+
+    async def stream_ai_reply(self, message: types.Message, chat_history, query):
+        # Отправляем ответ по первым токенам и дописываем его правками не чаще AI_STREAM_EDIT_INTERVAL
+        sent_message = None
+        ai_response = ""
+        shown_text = ""
+        last_edit = 0
+        try:
+            async with contextlib.aclosing(self.ai_dispatcher.stream(chat_history, query, message.chat.id)) as chunks:
+                async for chunk in chunks:
+                    ai_response += chunk
+                    if not ai_response.strip():
+                        continue
+                    if sent_message is None:
+                        sent_message = await message.reply(ai_response[:TELEGRAM_MESSAGE_LIMIT])
+                        shown_text, last_edit = ai_response, time.monotonic()
+                    elif time.monotonic() - last_edit >= AI_STREAM_EDIT_INTERVAL and len(shown_text) < TELEGRAM_MESSAGE_LIMIT:
+                        await self.edit_streamed_reply(sent_message, ai_response)
+                        shown_text, last_edit = ai_response, time.monotonic()
+        except aiogram.exceptions.TelegramAPIError:
+            raise
+        except AiUnavailableError as e:
+            if not ai_response.strip():
+                ai_response = str(e)
+        except Exception as e:
+            logger.error(f"Ошибка при получении потокового ответа от AI: {e!r}")
+            if not ai_response.strip():
+                ai_response = AI_FAILED_RESPONSE
+        if sent_message is None:
+            ai_response = ai_response if ai_response.strip() else AI_FAILED_RESPONSE
+            sent_message = await message.reply(ai_response[:TELEGRAM_MESSAGE_LIMIT])
+        elif ai_response != shown_text:
+            await self.edit_streamed_reply(sent_message, ai_response)
+        return sent_message, ai_response
+
+    def spawn(self, coro, name):
+        # Фоновая задача под присмотром: ссылка хранится до завершения, ошибки логируются и считаются
+        task = asyncio.create_task(coro, name=name)
+        self.background_tasks.add(task)
+        task.add_done_callback(self._on_background_task_done)
+        return task
+
+    def _on_background_task_done(self, task):
+        self.background_tasks.discard(task)
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None:
+            self.background_failures += 1
+            logger.error(f"Фоновая задача «{task.get_name()}» завершилась с ошибкой: {error!r}")
+
+    def save_bot_reply(self, chat_id, sent_message, text):
+        # Ответ бота сохраняется в фоне: отправка ответа уже состоялась
+        if chat_id == TARGET_CHAT_ID:
+            self.spawn(
+                self.save_chat_message(chat_id, self.bot_info.id, sent_message.message_id, "assistant", text),
+                f"сохранение ответа {sent_message.message_id}"
+            )
+
+    async def warm_chat_history(self, chat_id, after=None):
+        # Подгружает контекст чата в память, пока ответ ждёт своей очереди к AI
+        if after is not None:
+            await asyncio.wait([after])
+        reset_id = self.reset_ids.get(chat_id)
+        if self.context_cache.get(chat_id, reset_id) is None:
+            self.context_cache.fill(chat_id, *await self.load_chat_history(chat_id, reset_id))
+
     async def handle_message(self, message: types.Message):
+        started = time.monotonic()
+        route = "message"
         try:
             if not message.from_user or not message.text:
                 return
@@ -422,29 +2254,22 @@ class BotApp:
             user_id = message.from_user.id
             message_id = message.message_id
 
-            logger.info(f"Сообщение от {user_id} в чате {chat_id}: {message.text}")
+            log_sampled("Входящее сообщение", chat_id=chat_id, user_id=user_id, message_id=message_id, text=redact(message.text))
 
-            # Сохраняем ВСЕ сообщения в чате TARGET_CHAT_ID
+            # Сохраняем ВСЕ сообщения в чате TARGET_CHAT_ID; порядок внутри чата держит блокировка в save_chat_message
+            persist_task = None
             if chat_id == TARGET_CHAT_ID:
-                try:
-                    await self.save_chat_message(chat_id, user_id, message_id, "user", message.text)
-                except asyncpg.PostgresError as e:
-                    logger.error(f"Ошибка PostgreSQL при сохранении сообщения: {e}")
-                    # Продолжаем обработку, даже если сохранение не удалось
-                except Exception as e:
-                    logger.error(f"Неизвестная ошибка при сохранении сообщения: {e}")
-                    # Продолжаем обработку
-
-            # Реакция на сообщения от TARGET_USER_ID
-            if message.from_user.id == TARGET_USER_ID:
-                try:
-                    await self.bot.set_message_reaction(
-                        chat_id=message.chat.id,
-                        message_id=message.message_id,
-                        reaction=[TARGET_REACTION]
-                    )
-                except aiogram.exceptions.TelegramAPIError as e:
-                    logger.error(f"Ошибка при установке реакции: {e}")
+                persist_task = self.spawn(
+                    self.save_chat_message(chat_id, user_id, message_id, "user", message.text),
+                    f"сохранение сообщения {message_id}"
+                )
+
+            # Реакция на сообщения от TARGET_USER_ID ставится параллельно с ответом
+            if user_id == TARGET_USER_ID:
+                self.spawn(
+                    self.bot.set_message_reaction(chat_id=chat_id, message_id=message_id, reaction=[TARGET_REACTION]),
+                    f"реакция на {message_id}"
+                )
 
             # Проверяем, нужно ли обрабатывать сообщение как запрос к AI
             is_reply_to_bot = (message.reply_to_message and 
@@ -453,58 +2278,54 @@ class BotApp:
             is_tagged = bot_username in message_text
 
             if message_text in ['сосал?', 'sosal?']:
+                route = "trigger"
                 response = RARE_RESPONSE_SOSAL if random.random() < 0.1 else random.choice(RESPONSES_SOSAL)
                 sent_message = await message.reply(response)
-                if chat_id == TARGET_CHAT_ID:
-                    try:
-                        await self.save_chat_message(chat_id, bot_id, sent_message.message_id, "assistant", response)
-                    except asyncpg.PostgresError as e:
-                        logger.error(f"Ошибка PostgreSQL при сохранении ответа бота: {e}")
-                    except Exception as e:
-                        logger.error(f"Неизвестная ошибка при сохранении ответа бота: {e}")
+                self.save_bot_reply(chat_id, sent_message, response)
             elif message_text == 'летал?':
+                route = "trigger"
                 sent_message = await message.reply(RESPONSE_LETAL)
-                if chat_id == TARGET_CHAT_ID:
-                    try:
-                        await self.save_chat_message(chat_id, bot_id, sent_message.message_id, "assistant", RESPONSE_LETAL)
-                    except asyncpg.PostgresError as e:
-                        logger.error(f"Ошибка PostgreSQL при сохранении ответа бота: {e}")
-                    except Exception as e:
-                        logger.error(f"Неизвестная ошибка при сохранении ответа бота: {e}")
+                self.save_bot_reply(chat_id, sent_message, RESPONSE_LETAL)
             elif message_text == 'скамил?':
+                route = "trigger"
                 response = random.choice(RESPONSES_SCAMIL)
                 sent_message = await message.reply(response)
-                if chat_id == TARGET_CHAT_ID:
-                    try:
-                        await self.save_chat_message(chat_id, bot_id, sent_message.message_id, "assistant", response)
-                    except asyncpg.PostgresError as e:
-                        logger.error(f"Ошибка PostgreSQL при сохранении ответа бота: {e}")
-                    except Exception as e:
-                        logger.error(f"Неизвестная ошибка при сохранении ответа бота: {e}")
+                self.save_bot_reply(chat_id, sent_message, response)
             elif is_tagged or is_reply_to_bot:
+                route = "ai"
                 query = message_text.replace(bot_username, "").strip() if is_tagged else message_text
                 if not query:
                     sent_message = await message.reply("И хуле ты мне пишешь пустоту, петушара?")
-                    if chat_id == TARGET_CHAT_ID:
-                        try:
-                            await self.save_chat_message(chat_id, bot_id, sent_message.message_id, "assistant", "И хуле ты мне пишешь пустоту, петушара?")
-                        except asyncpg.PostgresError as e:
-                            logger.error(f"Ошибка PostgreSQL при сохранении ответа бота: {e}")
-                        except Exception as e:
-                            logger.error(f"Неизвестная ошибка при сохранении ответа бота: {e}")
+                    self.save_bot_reply(chat_id, sent_message, "И хуле ты мне пишешь пустоту, петушара?")
                     return
-                chat_history = await self.get_chat_history(chat_id)
-                if is_reply_to_bot and message.reply_to_message.text:
-                    chat_history.append({"role": "assistant", "content": message.reply_to_message.text})
-                ai_response = await AiHandler.get_ai_response(chat_history, query)
-                sent_message = await message.reply(ai_response)
-                if chat_id == TARGET_CHAT_ID:
-                    try:
-                        await self.save_chat_message(chat_id, bot_id, sent_message.message_id, "assistant", ai_response)
-                    except asyncpg.PostgresError as e:
-                        logger.error(f"Ошибка PostgreSQL при сохранении ответа бота: {e}")
-                    except Exception as e:
-                        logger.error(f"Неизвестная ошибка при сохранении ответа бота: {e}")
+                if not self.ai_dispatcher.join(chat_id, query):
+                    logger.info(f"Запрос к AI в чате {chat_id} объединён с ожидающим")
+                    return
+                prefetch_task = self.spawn(self.warm_chat_history(chat_id, after=persist_task), f"загрузка контекста {chat_id}")
+                try:
+                    async with self.ai_dispatcher.admit(chat_id):
+                        query = self.ai_dispatcher.take_batch(chat_id)
+                        # Контекст уже в памяти; при ошибке подгрузки get_chat_history сходит в БД сам
+                        await asyncio.wait([prefetch_task])
+                        chat_history = await self.get_chat_history(chat_id)
+                        if is_reply_to_bot and message.reply_to_message.text:
+                            chat_history.append({"role": "assistant", "content": message.reply_to_message.text})
+                        chat_history += await self.get_relevant_context(chat_id, query)
+                        if AI_STREAMING:
+                            sent_message, ai_response = await self.stream_ai_reply(message, chat_history, query)
+                        else:
+                            try:
+                                ai_response = await self.ai_dispatcher.complete(chat_history, query, chat_id)
+                            except AiUnavailableError as e:
+                                ai_response = str(e)
+                            except (openai.OpenAIError, asyncio.TimeoutError) as e:
+                                logger.error(f"Ошибка при получении ответа от AI: {e!r}")
+                                ai_response = AI_FAILED_RESPONSE
+                            sent_message = await message.reply(ai_response)
+                except AiUnavailableError as e:
+                    ai_response = str(e)
+                    sent_message = await message.reply(ai_response)
+                self.save_bot_reply(chat_id, sent_message, ai_response)
         except aiogram.exceptions.TelegramAPIError as e:
             logger.error(f"Ошибка Telegram API: {e}")
         except asyncpg.PostgresError as e:
@@ -513,26 +2334,139 @@ class BotApp:
             logger.error(f"Ошибка обработки данных: {e}")
         except Exception as e:
             logger.error(f"Неизвестная ошибка в обработке сообщения: {e}")
+        finally:
+            metrics.observe("bot_handler_seconds", time.monotonic() - started, {"route": route})
 
     def setup_handlers(self):
-        self.dp.message.register(self.command_start, Command("start"))
-        self.dp.message.register(self.command_version, Command("version"))
-        self.dp.message.register(self.command_reset, Command("reset"))
-        self.dp.message.register(partial(self.command_team_matches, team_name="real"), Command("real"))
-        self.dp.message.register(partial(self.command_team_matches, team_name="lfc"), Command("lfc"))
-        self.dp.message.register(partial(self.command_team_matches, team_name="arsenal"), Command("arsenal"))
+        self.dp.message.register(self.timed_handler("start", self.command_start), Command("start"))
+        self.dp.message.register(self.timed_handler("version", self.command_version), Command("version"))
+        self.dp.message.register(self.timed_handler("reset", self.command_reset), Command("reset"))
+        self.dp.message.register(self.timed_handler("search", self.command_search), Command("search"))
+        self.dp.callback_query.register(self.timed_handler("search", self.search_next_page), F.data.startswith("search:"))
+        self.dp.message.register(self.timed_handler("team", partial(self.command_team_matches, team_name="real")), Command("real"))
+        self.dp.message.register(self.timed_handler("team", partial(self.command_team_matches, team_name="lfc")), Command("lfc"))
+        self.dp.message.register(self.timed_handler("team", partial(self.command_team_matches, team_name="arsenal")), Command("arsenal"))
         self.dp.message.register(self.handle_message)
 
+    def create_web_app(self):
+        return create_webhook_app(self.dp, self.bot)
+
+    async def run_webhook(self):
+        await run_webhook_server(self.create_web_app(), create_stop_event())
+
     async def start(self):
         self.setup_handlers()
         await self.on_startup()
         try:
-            await self.dp.start_polling(self.bot, allowed_updates=["message"])
+            if WEBHOOK_URL:
+                await self.run_webhook()
+            else:
+                await self.dp.start_polling(self.bot, allowed_updates=ALLOWED_UPDATES)
+        finally:
+            await self.on_shutdown()
+
+    async def run_worker(self, updates):
+        # Обновления одного чата всегда приходят в этот процесс и в порядке Telegram,
+        # поэтому блокировки save_locks и кэш reset_id работают так же, как в одном процессе
+        self.setup_handlers()
+        await self.on_startup()
+        loop = asyncio.get_running_loop()
+        parent = multiprocessing.parent_process()
+        try:
+            while True:
+                try:
+                    raw = await loop.run_in_executor(None, updates.get, True, 1)
+                except queue.Empty:
+                    if parent is not None and not parent.is_alive():
+                        logger.error(f"Воркер {self.worker_index}: главный процесс завершился, останавливаемся")
+                        break
+                    continue
+                if raw is None:
+                    break
+                self.spawn(self.dp.feed_raw_update(self.bot, json.loads(raw)), "обработка обновления")
         finally:
             await self.on_shutdown()
 
+def run_worker_process(worker_index, updates):
+    # Останавливает воркер главный процесс, отправляя None в его очередь
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(BotApp(worker_index=worker_index).run_worker(updates))
+
+# Главный процесс в режиме WORKER_PROCESSES > 1: принимает обновления и раздаёт их воркерам по chat_id
+class UpdateIngester:
+    def __init__(self, processes=WORKER_PROCESSES):
+        self.bot = create_bot()
+        self.dp = Dispatcher()
+        self.dp.update.outer_middleware(self.route_update)
+        context = multiprocessing.get_context("spawn")
+        self.queues = [context.Queue(WORKER_QUEUE_SIZE) for _ in range(processes)]
+        # Обновления обрабатываются параллельными задачами; один поток на очередь сохраняет порядок,
+        # в котором они дошли до route_update, а общий пул потоков его перемешивал
+        self.feeders = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"bot-feeder-{index}") for index in range(processes)]
+        self.workers = [
+            context.Process(target=run_worker_process, args=(index, updates), name=f"bot-worker-{index}")
+            for index, updates in enumerate(self.queues)
+        ]
+        self.metrics_runner = None
+
+    def worker_for(self, chat_id):
+        return chat_id % len(self.queues)
+
+    async def route_update(self, handler, update, data):
+        # Обработчики aiogram здесь не вызываются: обновление целиком уходит воркеру
+        chat = data.get("event_chat")
+        user = data.get("event_from_user")
+        index = self.worker_for(chat.id if chat else user.id if user else 0)
+        raw = update.model_dump_json(exclude_unset=True)
+        # Полная очередь воркера притормаживает приём, а не теряет обновления
+        await asyncio.get_running_loop().run_in_executor(self.feeders[index], self.queues[index].put, raw)
+        metrics.inc("ingested_updates_total", {"worker": index})
+
+    async def metrics_endpoint(self, request: web.Request):
+        for index, updates in enumerate(self.queues):
+            metrics.set("worker_queue_depth", updates.qsize(), {"worker": index})
+        metrics.set("log_records_dropped", log_queue_handler.dropped)
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    async def stop_workers(self):
+        # None идёт через тот же поток, что и обновления, поэтому воркер получает его после них
+        for feeder, updates in zip(self.feeders, self.queues):
+            await asyncio.get_running_loop().run_in_executor(feeder, updates.put, None)
+            feeder.shutdown()
+        for worker in self.workers:
+            await asyncio.get_running_loop().run_in_executor(None, worker.join, WORKER_STOP_TIMEOUT)
+            if worker.is_alive():
+                logger.error(f"Воркер {worker.name} не остановился за {WORKER_STOP_TIMEOUT} с, завершаем принудительно")
+                worker.terminate()
+
+    async def start(self):
+        logger.info(f"Запуск бота версии {CODE_VERSION}: {len(self.workers)} воркеров")
+        for worker in self.workers:
+            worker.start()
+        if METRICS_PORT:
+            app = web.Application()
+            app.router.add_get("/metrics", self.metrics_endpoint)
+            self.metrics_runner = web.AppRunner(app)
+            await self.metrics_runner.setup()
+            await web.TCPSite(self.metrics_runner, METRICS_HOST, METRICS_PORT).start()
+        try:
+            if WEBHOOK_URL:
+                await set_bot_webhook(self.bot)
+                await run_webhook_server(create_webhook_app(self.dp, self.bot), create_stop_event())
+            else:
+                await self.dp.start_polling(self.bot, allowed_updates=ALLOWED_UPDATES)
+        finally:
+            logger.info("Остановка воркеров")
+            await self.stop_workers()
+            if self.metrics_runner:
+                await self.metrics_runner.cleanup()
+            if WEBHOOK_URL and WEBHOOK_DELETE_ON_SHUTDOWN:
+                await delete_bot_webhook(self.bot)
+            await self.bot.session.close()
+
 async def main():
-    bot_app = BotApp()
+    bot_app = UpdateIngester() if WORKER_PROCESSES > 1 else BotApp()
     try:
         logger.info("Запуск бота...")
         await bot_app.start()
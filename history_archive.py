@@ -0,0 +1,180 @@
+"""Потоковый экспорт и импорт chat_history в сжатый JSONL.
+
+Экспорт читает таблицу серверным курсором, импорт пишет пакетами через COPY, так что
+память не растёт с размером истории. Модуль не зависит от bot.py: его можно запускать
+без переменных окружения бота, а бот использует его для архивации перед удалением партиций
+и берёт отсюда схему партиций chat_history.
+
+    python history_archive.py export -o history.jsonl.gz --chat-id -1002362736664 --since 2024-05-01 --until 2024-06-01
+    python history_archive.py import history.jsonl.gz
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import logging
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+import asyncpg
+
+logger = logging.getLogger("history_archive")
+
+CHAT_HISTORY_COLUMNS = ["chat_id", "user_id", "message_id", "role", "content", "created_at", "reset_id"]
+EXPORT_PREFETCH = 1000  # строк за одно обращение серверного курсора и за одну запись в файл
+EXPORT_COMPRESS_LEVEL = 6  # как у gzip по умолчанию: 9 заметно медленнее при почти том же размере
+IMPORT_BATCH_SIZE = 5000  # строк в одном COPY при импорте
+
+
+# Помесячные партиции chat_history: календарный месяц в UTC
+def month_start(moment):
+    return moment.astimezone(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(moment):
+    return (moment + timedelta(days=32)).replace(day=1)
+
+
+def chat_history_partition_name(month):
+    return f"chat_history_{month:%Y_%m}"
+
+
+async def create_chat_history_partition(conn, month):
+    await conn.execute(
+        f"CREATE TABLE IF NOT EXISTS {chat_history_partition_name(month)} PARTITION OF chat_history "
+        f"FOR VALUES FROM ('{month.isoformat()}') TO ('{next_month(month).isoformat()}')"
+    )
+
+
+def record_to_line(record):
+    row = dict(zip(CHAT_HISTORY_COLUMNS, record))
+    row["created_at"] = row["created_at"].isoformat()
+    return json.dumps(row, ensure_ascii=False) + "\n"
+
+
+def write_records(file, records):
+    file.writelines(record_to_line(record) for record in records)
+
+
+def line_to_record(line):
+    row = json.loads(line)
+    row["created_at"] = datetime.fromisoformat(row["created_at"])
+    return tuple(row[column] for column in CHAT_HISTORY_COLUMNS)
+
+
+def build_export_query(chat_ids=None, since=None, until=None, reset_id=None):
+    # Фильтры по created_at отсекают лишние партиции ещё на этапе планирования
+    conditions, args = [], []
+    if chat_ids:
+        args.append(list(chat_ids))
+        conditions.append(f"chat_id = ANY(${len(args)}::bigint[])")
+    if since is not None:
+        args.append(since)
+        conditions.append(f"created_at >= ${len(args)}")
+    if until is not None:
+        args.append(until)
+        conditions.append(f"created_at < ${len(args)}")
+    if reset_id is not None:
+        args.append(reset_id)
+        conditions.append(f"reset_id = ${len(args)}")
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return f"SELECT {', '.join(CHAT_HISTORY_COLUMNS)} FROM chat_history {where} ORDER BY created_at, id", args
+
+
+async def export_chat_history(conn, path, chat_ids=None, since=None, until=None, reset_id=None):
+    # Пишем во временный файл и переименовываем: недописанный архив не выдаёт себя за готовый.
+    # Сериализация и сжатие идут в потоке пачками строк: бот выгружает целые партиции, и цикл событий не должен стоять
+    query, args = build_export_query(chat_ids, since, until, reset_id)
+    loop = asyncio.get_running_loop()
+    partial_path = f"{path}.part"
+    count = 0
+    try:
+        with gzip.open(partial_path, "wt", encoding="utf-8", compresslevel=EXPORT_COMPRESS_LEVEL) as file:
+            async with conn.transaction(readonly=True):
+                records = []
+                async for record in conn.cursor(query, *args, prefetch=EXPORT_PREFETCH):
+                    records.append(record)
+                    if len(records) >= EXPORT_PREFETCH:
+                        await loop.run_in_executor(None, write_records, file, records)
+                        count += len(records)
+                        records = []
+                await loop.run_in_executor(None, write_records, file, records)
+                count += len(records)
+        os.replace(partial_path, path)
+    except BaseException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    logger.info(f"Экспортировано {count} сообщений в {path}")
+    return count
+
+
+def read_batches(path, batch_size=IMPORT_BATCH_SIZE):
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        batch = []
+        for line in file:
+            if line.strip():
+                batch.append(line_to_record(line))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+async def import_chat_history(conn, path, batch_size=IMPORT_BATCH_SIZE):
+    # Строки добавляются к уже имеющимся: повторный импорт того же архива задвоит историю
+    months = set()
+    count = 0
+    for batch in read_batches(path, batch_size):
+        for record in batch:
+            month = month_start(record[CHAT_HISTORY_COLUMNS.index("created_at")])
+            if month not in months:
+                await create_chat_history_partition(conn, month)
+                months.add(month)
+        await conn.copy_records_to_table("chat_history", records=batch, columns=CHAT_HISTORY_COLUMNS)
+        count += len(batch)
+        logger.info(f"Импортировано {count} сообщений")
+    logger.info(f"Импорт {path} завершён: {count} сообщений")
+    return count
+
+
+def parse_date(value):
+    moment = datetime.fromisoformat(value)
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Экспорт и импорт chat_history в JSONL.gz")
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL"), help="По умолчанию DATABASE_URL")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export = commands.add_parser("export", help="Выгрузить историю в файл")
+    export.add_argument("-o", "--output", required=True, help="Файл .jsonl.gz")
+    export.add_argument("--chat-id", type=int, action="append", help="Можно указать несколько раз")
+    export.add_argument("--since", type=parse_date, help="Начало периода включительно, ISO-дата; без зоны — UTC")
+    export.add_argument("--until", type=parse_date, help="Конец периода не включительно")
+    export.add_argument("--reset-id", type=int)
+    restore = commands.add_parser("import", help="Загрузить историю из файла")
+    restore.add_argument("input", help="Файл .jsonl.gz")
+    restore.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    return parser.parse_args(argv)
+
+
+async def main(argv=None):
+    args = parse_args(argv)
+    if not args.database_url:
+        sys.exit("Укажите DATABASE_URL или --database-url")
+    conn = await asyncpg.connect(args.database_url)
+    try:
+        if args.command == "export":
+            await export_chat_history(conn, args.output, args.chat_id, args.since, args.until, args.reset_id)
+        else:
+            await import_chat_history(conn, args.input, args.batch_size)
+    finally:
+        await conn.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    asyncio.run(main())
@@ -1,15 +1,544 @@
 import pytest
+import pytest_asyncio
 import asyncio
-from bot import ApiClient  # Убедитесь, что имя файла соответствует
+import contextlib
+import json
+import time
+import types
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+from aiohttp.test_utils import TestClient, TestServer
+import bot
+import history_archive
+from bot import ApiClient, ResponseCache, ChatHistoryWriter, ChatContextCache, ContextBuilder, estimate_tokens, CircuitBreaker, AiDispatcher, AiUnavailableError, OutboundLimiter, Metrics  # Убедитесь, что имя файла соответствует
+
+@pytest_asyncio.fixture
+async def api_client():
+    client = ApiClient()
+    await client.start()
+    yield client
+    await client.close()
 
 @pytest.mark.asyncio
-async def test_get_weather():
-    result = await ApiClient.get_weather("Minsk,BY")
+async def test_get_weather(api_client):
+    result = await api_client.get_weather("Minsk,BY")
     assert isinstance(result, str)
     assert "°C" in result or "Нет данных" in result
 
 @pytest.mark.asyncio
-async def test_get_currency_rates():
-    usd_byn, usd_rub = await ApiClient.get_currency_rates()
-    assert isinstance(usd_byn, (float, int))
-    assert isinstance(usd_rub, (float, int))
+async def test_get_currency_rates(api_client):
+    rates = await api_client.get_currency_rates()
+    # Без сети курсов нет совсем, но нулей вместо них быть не должно
+    assert rates is None or all(rate > 0 for rate in rates)
+
+@pytest.mark.asyncio
+async def test_quotes_hedge_slow_provider_and_fall_back_to_last_good(monkeypatch):
+    client = ApiClient()
+    delays = {"slow": 0.5, "fast": 0.01}
+    failing = False
+
+    async def fake_get_json(url, headers=None):
+        await asyncio.sleep(delays[url])
+        return (500, None) if failing else (200, {"usd": {"byn": 3.2, "rub": 90.0}})
+
+    monkeypatch.setattr(client, "_get_json", fake_get_json)
+    monkeypatch.setattr(bot, "QUOTE_HEDGE_DEFAULT_DELAY", 0.05)
+    source = bot.QuoteSource("currency", [
+        bot.QuoteProvider("slow", "slow", bot.parse_currency_api_rates),
+        bot.QuoteProvider("fast", "fast", bot.parse_currency_api_rates),
+    ])
+    client.quotes["currency"] = source
+    started = time.monotonic()
+    values, age = await client.get_quote("currency")
+    assert values == (3.2, 90.0) and age < 1
+    assert time.monotonic() - started < 0.3
+    client.cache.entries.clear()
+    failing = True
+    values, age = await client.get_quote("currency")
+    assert values == (3.2, 90.0)
+    assert source.providers[1].error_rate > 0
+
+@pytest.mark.asyncio
+async def test_api_client_records_host_latency(api_client):
+    await api_client.get_currency_rates()
+    stats = api_client.get_latency_stats()
+    assert "cdn.jsdelivr.net" in stats
+    assert stats["cdn.jsdelivr.net"]["requests"] == 1
+
+@pytest.mark.asyncio
+async def test_response_cache_single_flight():
+    cache = ResponseCache()
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return calls
+
+    results = await asyncio.gather(*(cache.get_or_fetch("key", fetch, ttl=60) for _ in range(5)))
+    assert results == [1] * 5
+    assert calls == 1
+    assert await cache.get_or_fetch("key", fetch, ttl=60) == 1
+
+@pytest.mark.asyncio
+async def test_response_cache_serves_stale_and_revalidates():
+    cache = ResponseCache()
+    values = iter(["old", "new"])
+
+    async def fetch():
+        return next(values)
+
+    assert await cache.get_or_fetch("key", fetch, ttl=0.01, stale_ttl=60) == "old"
+    await asyncio.sleep(0.02)
+    assert await cache.get_or_fetch("key", fetch, ttl=0.01, stale_ttl=60) == "old"
+    await asyncio.sleep(0)
+    assert await cache.get_or_fetch("key", fetch, ttl=60) == "new"
+
+class FakeCopyPool:
+    def __init__(self, failures=0, delay=0, rejected=()):
+        self.failures = failures
+        self.delay = delay
+        self.rejected = set(rejected)  # message_id, на которых COPY падает с ошибкой в данных
+        self.batches = []
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        yield self
+
+    async def copy_records_to_table(self, table, records, columns):
+        await asyncio.sleep(self.delay)
+        if self.failures:
+            self.failures -= 1
+            raise OSError("connection refused")
+        if any(record[2] in self.rejected for record in records):
+            raise bot.asyncpg.CharacterNotInRepertoireError("invalid byte sequence for encoding \"UTF8\": 0x00")
+        self.batches.append(list(records))
+
+@pytest.mark.asyncio
+async def test_chat_history_writer_retries_failed_batch_in_order():
+    pool = FakeCopyPool(failures=1)
+    writer = ChatHistoryWriter(pool)
+    for message_id in range(3):
+        writer.enqueue((1, 2, message_id, "user", "text", float(message_id), 0))
+    assert await writer.flush() is False
+    assert [record[2] for record in writer.unflushed(1, 0)] == [0, 1, 2]
+    assert await writer.flush() is True
+    assert [record[2] for record in pool.batches[0]] == [0, 1, 2]
+    assert writer.unflushed(1, 0) == []
+
+@pytest.mark.asyncio
+async def test_chat_history_writer_drops_rejected_record_and_writes_the_rest():
+    pool = FakeCopyPool(rejected={3})
+    writer = ChatHistoryWriter(pool)
+    for message_id in range(8):
+        writer.enqueue((1, 2, message_id, "user", "text", float(message_id), 0))
+    assert await writer.flush() is True
+    assert [record[2] for batch in pool.batches for record in batch] == [0, 1, 2, 4, 5, 6, 7]
+    assert writer.unflushed(1, 0) == []
+
+@pytest.mark.asyncio
+async def test_chat_history_writer_close_keeps_batch_being_written():
+    pool = FakeCopyPool(delay=0.05)
+    writer = ChatHistoryWriter(pool)
+    writer.start()
+    for message_id in range(bot.CHAT_WRITE_BATCH_SIZE):
+        writer.enqueue((1, 2, message_id, "user", "text", float(message_id), 0))
+    await asyncio.sleep(0.01)
+    assert len(writer.inflight) == bot.CHAT_WRITE_BATCH_SIZE
+    # Остановка посреди COPY: пакет дописывается ровно один раз
+    await writer.close()
+    assert [record[2] for batch in pool.batches for record in batch] == list(range(bot.CHAT_WRITE_BATCH_SIZE))
+
+class FakePartitionConn:
+    def __init__(self, partitions):
+        self.partitions = partitions
+        self.executed = []
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        yield self
+
+    def transaction(self):
+        return contextlib.nullcontext()
+
+    async def fetch(self, query):
+        return [{"relname": name} for name in self.partitions]
+
+    async def execute(self, query, *args):
+        if query.startswith("DROP"):
+            raise bot.asyncpg.PostgresError("lock timeout")
+        self.executed.append(query)
+
+@pytest.mark.asyncio
+async def test_cleanup_creates_partitions_even_if_drop_fails():
+    app = bot.BotApp()
+    app.db_pool = FakePartitionConn(["chat_history_2000_01"])
+    await app.cleanup_old_messages()
+    next_month = bot.next_month(bot.month_start(bot.datetime.now(bot.timezone.utc)))
+    assert any(bot.chat_history_partition_name(next_month) in query for query in app.db_pool.executed)
+    await app.bot.session.close()
+
+@pytest.mark.asyncio
+async def test_archive_partition_reports_database_errors(monkeypatch, tmp_path):
+    async def failing_export(conn, path, since=None, until=None):
+        raise bot.asyncpg.PostgresError("canceling statement due to conflict with recovery")
+
+    monkeypatch.setattr(bot, "ARCHIVE_DIR", str(tmp_path))
+    monkeypatch.setattr(bot, "export_chat_history", failing_export)
+    app = bot.BotApp()
+    # Партиция не удаляется, а ошибка не обрывает остальную очистку
+    assert await app.archive_partition(None, "chat_history_2000_01", bot.datetime(2000, 1, 1, tzinfo=bot.timezone.utc)) is False
+    await app.bot.session.close()
+
+def test_chat_context_cache_ring_buffer_and_lru():
+    cache = ChatContextCache(max_chats=2, limit=2)
+    cache.fill(1, 0, [])
+    for n in range(3):
+        cache.append(1, 0, (float(n), "user", str(n)))
+    assert [content for _, _, content in cache.get(1, 0)] == ["1", "2"]
+    assert cache.get(1, 1) is None
+    cache.fill(2, 0, [])
+    cache.fill(3, 0, [])
+    assert cache.get(1, 0) is None
+
+def test_context_builder_keeps_newest_turns_within_budget():
+    builder = ContextBuilder(token_budget=estimate_tokens("новое сообщение") * 2)
+    turns = [(float(n), "user", text) for n, text in enumerate(["старое сообщение " * 50, "новое сообщение", "новое сообщение"])]
+    messages = builder.build(1, 0, turns)
+    assert messages == [{"role": "user", "content": "новое сообщение"}] * 2
+    assert builder.summaries[1]["pending"] == turns[:1]
+
+def test_context_builder_advances_window_in_blocks():
+    builder = ContextBuilder(token_budget=estimate_tokens("сообщение") * 4, block_turns=2)
+    turns = [(float(n), "user", "сообщение") for n in range(4)]
+    assert len(builder.build(1, 0, turns)) == 4
+    window_starts = []
+    for n in range(4, 8):
+        turns.append((float(n), "user", "сообщение"))
+        builder.build(1, 0, turns)
+        window_starts.append(builder.summaries[1]["window_start"])
+    # Начало окна стоит на месте, пока окно влезает, и прыгает сразу на два сообщения
+    assert window_starts == [2.0, 2.0, 4.0, 4.0]
+
+def test_ai_prompt_keeps_static_prefix_and_records_cache_usage_per_chat():
+    messages = bot.AiHandler.build_messages([{"role": "user", "content": "привет"}], "вопрос")
+    assert messages[0] == {"role": "system", "content": bot.SYSTEM_PROMPT}
+    assert messages[-2]["content"].startswith("Сегодня")
+    usage = types.SimpleNamespace(prompt_tokens=100, completion_tokens=10, prompt_cache_hit_tokens=64, prompt_cache_miss_tokens=36)
+    bot.record_ai_usage(usage, "chat", 42)
+    assert bot.metrics.counters["ai_prompt_cache_hit_tokens_total"][(("chat_id", 42), ("kind", "chat"))] >= 64
+
+def test_circuit_breaker_opens_after_threshold():
+    breaker = CircuitBreaker(threshold=2, cooldown=60)
+    breaker.record_failure()
+    breaker.check()
+    breaker.record_failure()
+    with pytest.raises(AiUnavailableError):
+        breaker.check()
+
+@pytest.mark.asyncio
+async def test_ai_dispatcher_coalesces_queued_questions():
+    dispatcher = AiDispatcher()
+    assert dispatcher.join(1, "первый") is True
+    assert dispatcher.join(1, "второй") is False
+    async with dispatcher.admit(1):
+        assert dispatcher.take_batch(1) == "первый\nвторой"
+        assert dispatcher.join(1, "третий") is True
+
+class FakeLockConn:
+    def __init__(self, lock_free):
+        self.lock_free = lock_free
+        self.closed = False
+        self.queries = []
+
+    def is_closed(self):
+        return self.closed
+
+    async def fetchval(self, query, *args):
+        self.queries.append(query)
+        return self.lock_free
+
+    async def execute(self, query):
+        self.queries.append(query)
+
+@pytest.mark.asyncio
+async def test_scheduler_pauses_when_lock_connection_closes(monkeypatch):
+    # Блокировку за это время захватил другой процесс: новое соединение её не получает
+    new_conn = FakeLockConn(lock_free=False)
+
+    async def connect(dsn):
+        return new_conn
+
+    monkeypatch.setattr(bot.asyncpg, "connect", connect)
+    monkeypatch.setattr(bot, "SCHEDULER_LOCK_RETRY", 0.01)
+    app = bot.BotApp()
+    app.scheduler = bot.AsyncIOScheduler()
+    app.scheduler.start()
+    app.scheduler_conn = FakeLockConn(lock_free=True)
+    task = asyncio.create_task(app.lead_scheduler())
+    await asyncio.sleep(0.03)
+    app.scheduler_conn.closed = True
+    await asyncio.sleep(0.05)
+    task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await task
+    assert app.scheduler.state == bot.STATE_PAUSED
+    assert new_conn.queries and all("pg_try_advisory_lock" in query for query in new_conn.queries)
+    app.scheduler.shutdown(wait=False)
+    await app.bot.session.close()
+
+class FakeReplyMessage:
+    def __init__(self):
+        self.chat = types.SimpleNamespace(id=1)
+        self.replies = []
+
+    async def reply(self, text, **kwargs):
+        self.replies.append(text)
+        return types.SimpleNamespace(chat=self.chat, message_id=100 + len(self.replies))
+
+@pytest.mark.asyncio
+async def test_stream_ai_reply_sends_early_and_throttles_edits(monkeypatch):
+    app = bot.BotApp()
+    edits = []
+
+    async def fake_edit(chat_id, message_id, text):
+        edits.append(text)
+
+    async def fake_stream(chat_history, query, chat_id=None):
+        for chunk in ["", " ", "При", "вет"]:
+            yield chunk
+        await asyncio.sleep(0.06)
+        yield "!"
+        yield " Пока"
+
+    monkeypatch.setattr(bot, "AI_STREAM_EDIT_INTERVAL", 0.05)
+    monkeypatch.setattr(app.bot, "edit_message_text", fake_edit)
+    monkeypatch.setattr(app.ai_dispatcher, "stream", fake_stream)
+    message = FakeReplyMessage()
+    sent_message, ai_response = await app.stream_ai_reply(message, [], "вопрос")
+    # Ответ уходит на первом непустом фрагменте, «вет» не стоит отдельной правки, последняя правка — полный текст
+    assert message.replies == [" При"]
+    assert edits == [" Привет!", " Привет! Пока"]
+    assert ai_response == " Привет! Пока" and sent_message.message_id == 101
+
+    async def empty_stream(chat_history, query, chat_id=None):
+        return
+        yield
+
+    async def unavailable_stream(chat_history, query, chat_id=None):
+        raise AiUnavailableError(bot.AI_UNAVAILABLE_RESPONSE)
+        yield
+
+    for stream, canned in ((empty_stream, bot.AI_FAILED_RESPONSE), (unavailable_stream, bot.AI_UNAVAILABLE_RESPONSE)):
+        monkeypatch.setattr(app.ai_dispatcher, "stream", stream)
+        message = FakeReplyMessage()
+        assert (await app.stream_ai_reply(message, [], "вопрос"))[1] == canned
+        assert message.replies == [canned]
+    assert len(edits) == 2
+    await app.bot.session.close()
+
+@pytest.mark.asyncio
+async def test_ai_dispatcher_times_out_without_retry_and_trips_breaker(monkeypatch):
+    dispatcher = AiDispatcher()
+    dispatcher.breaker = CircuitBreaker(threshold=2, cooldown=60)
+    calls = 0
+
+    async def slow_response(chat_history, query, chat_id=None):
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(10)
+
+    monkeypatch.setattr(bot, "AI_REQUEST_TIMEOUT", 0.05)
+    monkeypatch.setattr(bot.AiHandler, "get_ai_response", slow_response)
+    monkeypatch.setattr(bot.AiHandler, "summarize", slow_response)
+    with pytest.raises(asyncio.TimeoutError):
+        await dispatcher.complete([], "вопрос")
+    with pytest.raises(asyncio.TimeoutError):
+        await dispatcher.summarize("", [])
+    assert calls == 2
+    with pytest.raises(AiUnavailableError):
+        await dispatcher.complete([], "вопрос")
+
+class FakeMorningApi:
+    async def get_weather(self, code):
+        return "5°C, ясно"
+
+    async def get_quote(self, instrument):
+        if instrument == "crypto":
+            await asyncio.sleep(10)
+        return (3.2, 90.0), 0
+
+    def last_quote(self, instrument):
+        return None
+
+@pytest.mark.asyncio
+async def test_morning_message_survives_slow_source_and_reaches_every_chat(monkeypatch):
+    sent = []
+
+    async def send_message(chat_id, text, parse_mode=None):
+        sent.append((chat_id, text))
+
+    monkeypatch.setattr(bot, "MORNING_SEND_TIMEOUT", 0.05)
+    monkeypatch.setattr(bot, "MORNING_CHAT_IDS", [-100, -200, 300])
+    sender = bot.MorningMessageSender(types.SimpleNamespace(send_message=send_message), FakeMorningApi())
+    started = time.monotonic()
+    await sender.send_morning_message()
+    assert time.monotonic() - started < 1
+    assert [chat_id for chat_id, _ in sent] == [-100, -200, 300]
+    text = sent[0][1]
+    assert "₿ *BTC*: Нет данных" in text and "🌍 *WLD*: Нет данных" in text
+    assert "💵 *USD/BYN*: 3.20 BYN" in text and "5°C, ясно" in text
+
+RECORDED_UPDATE = {
+    "update_id": 1,
+    "message": {
+        "message_id": 10,
+        "date": 1700000000,
+        "chat": {"id": 1, "type": "private"},
+        "from": {"id": 2, "is_bot": False, "first_name": "Тест"},
+        "text": "привет"
+    }
+}
+
+@pytest.mark.asyncio
+async def test_webhook_server_checks_secret_and_serves_health(monkeypatch):
+    monkeypatch.setattr(bot, "WEBHOOK_SECRET", "secret")
+    app = bot.BotApp()
+    async with TestClient(TestServer(app.create_web_app())) as client:
+        health = await client.get("/health")
+        assert health.status == 200
+        assert (await health.json())["status"] == "ok"
+        rejected = await client.post(bot.WEBHOOK_PATH, json=RECORDED_UPDATE)
+        assert rejected.status == 401
+        accepted = await client.post(bot.WEBHOOK_PATH, json=RECORDED_UPDATE, headers={"X-Telegram-Bot-Api-Secret-Token": "secret"})
+        assert accepted.status == 200
+    await app.bot.session.close()
+
+@pytest.mark.asyncio
+async def test_ingester_routes_updates_of_one_chat_to_one_worker():
+    ingester = bot.UpdateIngester(processes=2)
+    for update_id, chat_id in enumerate([10, 11, 10]):
+        message = {**RECORDED_UPDATE["message"], "chat": {"id": chat_id, "type": "private"}}
+        await ingester.dp.feed_raw_update(ingester.bot, {"update_id": update_id, "message": message})
+    assert [json.loads(ingester.queues[0].get(timeout=1))["update_id"] for _ in range(2)] == [0, 2]
+    assert json.loads(ingester.queues[1].get(timeout=1))["message"]["chat"]["id"] == 11
+    await ingester.bot.session.close()
+
+@pytest.mark.asyncio
+async def test_ingester_keeps_order_of_concurrently_handled_updates():
+    ingester = bot.UpdateIngester(processes=1)
+    # Как при handle_as_tasks: все обновления чата обрабатываются одновременно
+    await asyncio.gather(*(
+        ingester.dp.feed_raw_update(ingester.bot, {"update_id": update_id, "message": RECORDED_UPDATE["message"]})
+        for update_id in range(300)
+    ))
+    assert [json.loads(ingester.queues[0].get(timeout=1))["update_id"] for _ in range(300)] == list(range(300))
+    await ingester.bot.session.close()
+
+@pytest.mark.asyncio
+async def test_outbound_limiter_retries_after_flood_control():
+    limiter = OutboundLimiter()
+    method = SendMessage(chat_id=-100, text="ответ")
+    calls = []
+
+    async def make_request(bot_instance, telegram_method):
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            raise TelegramRetryAfter(method=telegram_method, message="Too Many Requests", retry_after=0.05)
+        return "ok"
+
+    assert await limiter(make_request, None, method) == "ok"
+    assert calls[1] - calls[0] >= 0.05
+    assert limiter.depth == 0
+    await limiter.close()
+
+@pytest.mark.asyncio
+async def test_outbound_limiter_throttled_chat_does_not_delay_others():
+    limiter = OutboundLimiter()
+    limiter._chat_bucket(-100).tokens = 0  # группа исчерпала свои 20 сообщений в минуту
+    sent = []
+
+    async def make_request(bot_instance, telegram_method):
+        if isinstance(telegram_method, bot.SetMessageReaction) and not sent:
+            sent.append("retry")
+            raise TelegramRetryAfter(method=telegram_method, message="Too Many Requests", retry_after=5)
+        sent.append(telegram_method.chat_id)
+        return "ok"
+
+    throttled = asyncio.create_task(limiter(make_request, None, SendMessage(chat_id=-100, text="правка")))
+    blocked_reaction = asyncio.create_task(limiter(make_request, None, bot.SetMessageReaction(chat_id=-300, message_id=1, reaction=[])))
+    await asyncio.sleep(0.01)
+    started = time.monotonic()
+    # Ни лимит группы, ни RetryAfter на реакции в другом чате не задерживают ответ в личку
+    assert await limiter(make_request, None, SendMessage(chat_id=200, text="ответ")) == "ok"
+    assert time.monotonic() - started < 0.1
+    assert sent == ["retry", 200]
+    throttled.cancel()
+    blocked_reaction.cancel()
+    await limiter.close()
+
+def test_aiogram_update_log_is_sampled(monkeypatch, caplog):
+    monkeypatch.setattr(bot, "LOG_MESSAGE_SAMPLE_RATE", 0)
+    event_logger = bot.logging.getLogger("aiogram.event")
+    with caplog.at_level(bot.logging.INFO, logger="aiogram.event"):
+        event_logger.info("Update id=1 is handled. Duration 1 ms by bot id=1")
+        event_logger.warning("Update id=2 is not handled")
+    assert [record.levelname for record in caplog.records] == ["WARNING"]
+
+def test_metrics_render_prometheus_text():
+    registry = Metrics()
+    registry.inc("requests_total", {"host": "api.example.com"})
+    registry.observe("latency_seconds", 0.02, {"route": "ai"})
+    text = registry.render()
+    assert 'requests_total{host="api.example.com"} 1' in text
+    assert 'latency_seconds_bucket{route="ai",le="0.025"} 1' in text
+    assert 'latency_seconds_bucket{route="ai",le="0.01"} 0' in text
+    assert 'latency_seconds_count{route="ai"} 1' in text
+
+@pytest.mark.asyncio
+async def test_search_page_carries_keyset_cursor():
+    app = bot.BotApp()
+    created_at = bot.datetime(2024, 5, 1, 12, 0, tzinfo=bot.timezone.utc)
+    rows = [{"id": 100 - n, "created_at": created_at - bot.timedelta(minutes=n), "role": "user", "content": f"гол {n}"} for n in range(bot.SEARCH_PAGE_SIZE + 1)]
+    text, keyboard = app.format_search_page("abcd1234", rows)
+    assert text.count("гол") == bot.SEARCH_PAGE_SIZE
+    cursor = keyboard.inline_keyboard[0][0].callback_data
+    last = rows[bot.SEARCH_PAGE_SIZE - 1]
+    assert cursor == f"search:abcd1234:{int(last['created_at'].timestamp() * 1_000_000)}:{last['id']}"
+    assert len(cursor.encode()) <= 64
+    assert app.format_search_page("abcd1234", rows[:1])[1] is None
+    await app.bot.session.close()
+
+class FakeArchiveConn:
+    def __init__(self, rows):
+        self.rows = rows
+        self.executed = []
+        self.copied = []
+
+    def transaction(self, **kwargs):
+        return contextlib.nullcontext()
+
+    async def cursor(self, query, *args, prefetch=None):
+        for row in self.rows:
+            yield row
+
+    async def execute(self, query):
+        self.executed.append(query)
+
+    async def copy_records_to_table(self, table, records, columns):
+        self.copied.append(list(records))
+
+@pytest.mark.asyncio
+async def test_history_archive_round_trip(tmp_path):
+    rows = [
+        (-100, 1, n, "user", f"сообщение {n}", bot.datetime(2024, 4 + n // 2, 28, tzinfo=bot.timezone.utc), 0)
+        for n in range(3)
+    ]
+    path = str(tmp_path / "history.jsonl.gz")
+    assert await history_archive.export_chat_history(FakeArchiveConn(rows), path) == 3
+    conn = FakeArchiveConn([])
+    assert await history_archive.import_chat_history(conn, path, batch_size=2) == 3
+    assert [len(batch) for batch in conn.copied] == [2, 1]
+    assert sum(conn.copied, []) == rows
+    assert [query.split()[5] for query in conn.executed] == ["chat_history_2024_04", "chat_history_2024_05"]